@@ -1,22 +1,62 @@
 import streamlit as st
 import pandas as pd
-import re
 import json
-from datetime import datetime
-from supabase import create_client, Client
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as TiempoAgotado
+from datetime import datetime, timedelta
+from supabase import create_client
 import streamlit.components.v1 as components
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from repositorio import RepositorioSupabase, RepositorioSQLite
+from carritos import DiarioCarritos, Despachador
+import exportar
+import metricas
+from metricas import RepositorioInstrumentado, medir_pantalla
+from inventario import (
+    COLUMNAS_MAESTRO, construir_catalogo, nuevo_libro, actualizar_libro, columna_stock, tabla_stock,
+    actualizar_libro_global, filas_libro_global, matriz_stock, leer_conteo, conciliar_conteo,
+    reporte_mensual, MantenedorSaldos, df_movimientos, df_editable,
+    diff_maestro, guardar_diff_maestro, importar_catalogo
+)
 
 # ==========================================
 # 1. CONFIGURACIÓN Y CONEXIÓN
 # ==========================================
+@st.cache_resource(show_spinner=False)
+def _repositorio_sqlite(ruta):
+    return RepositorioSQLite(ruta)
+
+# Se crea una vez por proceso y se comparte entre sesiones; si deja de responder se recrea
+@st.cache_resource(show_spinner=False, validate=lambda r: r.sano())
+def _repositorio_supabase(url, key):
+    return RepositorioSupabase(lambda: create_client(url, key))
+
 try:
-    URL = st.secrets["SUPABASE_URL"]
-    KEY = st.secrets["SUPABASE_KEY"]
-    supabase: Client = create_client(URL, KEY)
+    # BACKEND = "sqlite" corre todo contra un archivo local (SQLITE_PATH), sin red ni Supabase
+    BACKEND = st.secrets.get("BACKEND", "supabase")
+    if BACKEND == "sqlite":
+        repo = _repositorio_sqlite(st.secrets.get("SQLITE_PATH", "inventario.db"))
+    else:
+        URL = st.secrets["SUPABASE_URL"]
+        KEY = st.secrets["SUPABASE_KEY"]
+        repo = _repositorio_supabase(URL, KEY)
+    # Cada llamada queda registrada para la vista de Diagnóstico
+    repo = RepositorioInstrumentado(repo)
 except Exception as e:
-    st.error(f"Error de conexión con Supabase: {e}")
+    st.error(f"Error de conexión con la base de datos: {e}")
     st.stop()
 
+# Agregado de stock en el servidor (ver sql/stock_por_local.sql). Si no está habilitado o falla,
+# se usa el libro incremental del cliente. Stock por Sede usa siempre el agregado
+# (sql/stock_por_sede.sql) y solo recurre al libro si la función no está instalada.
+USAR_RPC_STOCK = bool(st.secrets.get("USAR_RPC_STOCK", False))
+# Filas por insert al guardar un carrito (ver sql/movimientos_lote.sql)
+LOTE_CHUNK = int(st.secrets.get("LOTE_CHUNK", 200))
+# Segundos entre pasadas del hilo que mantiene saldos_mensuales; 0 lo apaga (p. ej. si pg_cron
+# ya llama a actualizar_saldos, ver sql/saldos_mensuales.sql)
+SALDOS_INTERVALO = int(st.secrets.get("SALDOS_INTERVALO", 60))
+
 # ==========================================
 # 2. GESTIÓN DE SESIÓN Y AUTH
 # ==========================================
@@ -33,8 +73,6 @@ def sync_session():
 def logout():
     if "auth_user" in st.session_state:
         del st.session_state.auth_user
-    if "carritos" in st.session_state:
-        st.session_state.carritos = {}
     if "audit_list" in st.session_state:
         del st.session_state.audit_list
     st.query_params.clear()
@@ -65,21 +103,141 @@ st.markdown(f"""
 # ==========================================
 def get_locales_map():
     try:
-        res = supabase.table("locales").select("id, nombre").execute().data
+        res = repo.listar_locales()
         return {l['nombre']: l['id'] for l in res} if res else {}
     except: return {}
 
-def extraer_valor_formato(formato_str):
-    match = re.search(r"(\d+)", str(formato_str))
-    return int(match.group(1)) if match else 1
+CATALOGO_TTL = 300  # segundos
+
+@st.cache_resource(ttl=CATALOGO_TTL, show_spinner=False)
+def cargar_catalogo():
+    # Compartido entre sesiones: el mapa y el índice de búsqueda se arman una sola vez por TTL
+    return construir_catalogo(repo.listar_productos())
+
+def invalidar_catalogo():
+    cargar_catalogo.clear()
+
+PAGINA_MOVIMIENTOS = 1000
+LIBRO_RESYNC = 1800  # segundos entre reconstrucciones completas del libro
+
+@st.cache_resource(show_spinner=False)
+def _libros_stock():
+    # Un libro por sede, compartido entre sesiones: stock acumulado + marca segura de ids ya sumados
+    return {"lock": threading.Lock(), "sedes": {}}
+
+def _libro_sede(local_id):
+    libros = _libros_stock()
+    with libros["lock"]:
+        libro = libros["sedes"].get(local_id)
+        if libro is None or time.time() - libro["creado"] > LIBRO_RESYNC:
+            # La reconstrucción periódica recoge ediciones/borrados hechos directo en la DB
+            libro = dict(nuevo_libro(), lock=threading.Lock())
+            libros["sedes"][local_id] = libro
+        return libro
 
 def obtener_stock_dict(local_id):
-    try:
-        res = supabase.table("movimientos_inventario").select("id_producto, cantidad").eq("id_local", local_id).execute().data
-        if not res: return {}
-        df = pd.DataFrame(res)
-        return df.groupby("id_producto")["cantidad"].sum().to_dict()
-    except: return {}
+    if USAR_RPC_STOCK:
+        try: return repo.stock_agregado(local_id)
+        except: pass
+    # Un error aquí llega a la pantalla: un {} se vería como stock cero en todos los productos
+    libro = _libro_sede(local_id)
+    with libro["lock"]:
+        return dict(actualizar_libro(repo, libro, local_id, PAGINA_MOVIMIENTOS))
+
+@st.cache_resource(show_spinner=False)
+def _libro_global():
+    # Stock de todas las sedes por (sede, producto, ubicación), compartido entre sesiones
+    return dict(nuevo_libro(), lock=threading.Lock())
+
+def obtener_stock_sedes(por_ubicacion=False):
+    # Una sola consulta agregada para todas las sedes en vez de una por sede. El libro de todas las
+    # sedes recorre el historial completo la primera vez: es solo el respaldo
+    try: return repo.stock_por_sede(por_ubicacion)
+    except Exception: pass
+    libro = _libro_global()
+    with libro["lock"]:
+        if time.time() - libro["creado"] > LIBRO_RESYNC: libro.update(nuevo_libro())
+        actualizar_libro_global(repo, libro, PAGINA_MOVIMIENTOS)
+        return filas_libro_global(libro["stock"], por_ubicacion)
+
+CONSULTA_TIMEOUT = 30  # segundos por consulta en paralelo
+
+@st.cache_resource(show_spinner=False)
+def _pool_consultas():
+    return ThreadPoolExecutor(max_workers=16, thread_name_prefix="consultas")
+
+def _en_pool(fn):
+    # El hilo del pool hereda el contexto del rerun (Streamlit y métricas)
+    ctx, med = get_script_run_ctx(), metricas.capturar_contexto()
+    def correr():
+        add_script_run_ctx(threading.current_thread(), ctx)
+        metricas.aplicar_contexto(med)
+        return fn()
+    return _pool_consultas().submit(correr)
+
+def precargar(*fns):
+    # Calienta cachés sin esperar: quien las pida después espera al mismo cálculo
+    for fn in fns: _en_pool(fn)
+
+# Valor con el que se sigue si una consulta se pasa de su límite; sin respaldo, el timeout se propaga.
+# El stock no tiene un valor por defecto creíble: None avisa a la pantalla que no está disponible.
+RESPALDOS = {"stock": lambda: None, "catalogo": lambda: construir_catalogo([])}
+STOCK_NO_DISPONIBLE = "El stock no está disponible en este momento. Reintenta en unos segundos."
+
+def consultar_en_paralelo(tareas, timeouts=None, respaldos=None):
+    # tareas: {nombre: fn}. El rerun espera a la más lenta, no a la suma; cada una tiene su propio límite
+    timeouts = timeouts or {}
+    respaldos = {**RESPALDOS, **(respaldos or {})}
+    inicio = time.monotonic()
+    futuros = {n: _en_pool(fn) for n, fn in tareas.items()}
+    res = {}
+    for n, f in futuros.items():
+        try:
+            res[n] = f.result(timeout=max(inicio + timeouts.get(n, CONSULTA_TIMEOUT) - time.monotonic(), 0))
+        except TiempoAgotado:
+            if n not in respaldos: raise
+            res[n] = respaldos[n]()
+            # Con None la pantalla explica por su cuenta qué queda sin datos
+            if res[n] is not None: st.warning(f"La consulta de {n} tardó demasiado; se muestra sin esos datos. Reintenta en unos segundos.")
+    return res
+
+BUSQUEDA_TOP_K = 20
+
+def selector_producto(catalogo, key, etiqueta="Selecciona producto:"):
+    # Solo viajan al navegador los mejores resultados, no el catálogo completo
+    q = st.text_input("Buscar producto (nombre, SKU o código):", key=f"{key}_q")
+    if not q: return None
+    opciones = catalogo["indice"].buscar(q, BUSQUEDA_TOP_K)
+    if not opciones:
+        st.caption("Sin resultados.")
+        return None
+    sel = st.selectbox(etiqueta, opciones, key=f"{key}_sel")
+    return catalogo["prod_map"][sel]
+
+def boton_exportar(etiqueta, nombre, trozos, key):
+    # trozos() arma el generador recién al hacer clic: el archivo se escribe por partes a un temporal
+    c_fmt, c_btn = st.columns([1, 2])
+    formato = c_fmt.selectbox("Formato:", list(exportar.FORMATOS), key=f"{key}_fmt", label_visibility="collapsed")
+    sufijo, mime = exportar.FORMATOS[formato]
+    c_btn.download_button(etiqueta, lambda: exportar.exportar(trozos(), formato), f"{nombre}{sufijo}", mime, key=f"{key}_btn")
+
+@st.cache_resource(show_spinner=False)
+def _carritos(_repo):
+    # Diario local de carritos + hilo que envía los lotes confirmados, uno por proceso
+    diario = DiarioCarritos(st.secrets.get("CARRITOS_PATH", "carritos.db"))
+    despachador = Despachador(diario, _repo, LOTE_CHUNK)
+    despachador.start()
+    return diario, despachador
+
+@st.cache_resource(show_spinner=False)
+def _mantenedor_saldos(_repo):
+    mantenedor = MantenedorSaldos(_repo, SALDOS_INTERVALO)
+    mantenedor.start()
+    return mantenedor
+
+UBICACIONES = ["Bodega", "Frío", "Cocina", "Producción"]
+TIPOS_MOVIMIENTO = ["AJUSTE", "SALDO_INICIAL"]
+HISTORIAL_PAGINA = 100
 
 # ==========================================
 # 5. CALCULADORA
@@ -170,28 +328,24 @@ def calculadora_basica():
 # ==========================================
 # 6. PANTALLA: INGRESO
 # ==========================================
+@medir_pantalla
 def ingreso_inventario_pantalla(local_id, user_key):
     st.header("📋 Ingreso de Inventario")
-    if 'carritos' not in st.session_state: st.session_state.carritos = {}
-    if user_key not in st.session_state.carritos: st.session_state.carritos[user_key] = []
+    diario, despachador = _carritos(repo)
     if 'show_calc' not in st.session_state: st.session_state.show_calc = False
     if 'resultado_calc' not in st.session_state: st.session_state.resultado_calc = None
     if 'prod_search_key' not in st.session_state: st.session_state.prod_search_key = 0
 
-    res = supabase.table("productos_maestro").select("*").execute().data
-    if not res:
+    catalogo = cargar_catalogo()
+    if not catalogo["productos"]:
         st.warning("No hay productos.")
         return
 
-    prod_map = {f"{p['nombre']} | {p['formato_medida']}": p for p in res}
-    opciones = sorted(list(prod_map.keys()))
-    
-    sel = st.selectbox("Selecciona producto:", [""] + opciones, key=f"search_{st.session_state.prod_search_key}")
+    p = selector_producto(catalogo, f"search_{st.session_state.prod_search_key}")
     
-    if sel:
-        p = prod_map[sel]
+    if p:
         c1, c2, c3 = st.columns([2, 2, 0.6])
-        with c1: ubi = st.selectbox("Ubicación:", ["Bodega", "Frío", "Cocina", "Producción"])
+        with c1: ubi = st.selectbox("Ubicación:", UBICACIONES)
         with c2:
             placeholder_cant = st.empty()
             val_a_mostrar = float(st.session_state.resultado_calc) if st.session_state.resultado_calc is not None else None
@@ -217,19 +371,27 @@ def ingreso_inventario_pantalla(local_id, user_key):
                     st.rerun()
 
         if st.button("Añadir a la lista"):
-            st.session_state.carritos[user_key].append({
+            diario.agregar_linea(user_key, local_id, {
                 "id_producto": p['id'], "Producto": p['nombre'], "Ubicación": ubi,
-                "Cantidad": float(cant if cant is not None else 0), "Formato": p['formato_medida'], "Factor": extraer_valor_formato(p['formato_medida'])
+                "Cantidad": float(cant if cant is not None else 0), "Formato": p['formato_medida'], "Factor": p['factor']
             })
             st.toast("✅ Añadido")
             st.session_state.resultado_calc = None
             st.session_state.prod_search_key += 1
             st.rerun()
 
-    if st.session_state.carritos[user_key]:
+    for l in diario.estado_lotes(user_key, local_id):
+        hora = datetime.fromtimestamp(l['creado']).strftime('%H:%M')
+        if l['estado'] == "enviado": st.caption(f"✅ Ingreso de las {hora} guardado ({l['lineas']} líneas).")
+        elif l['ultimo_error']: st.warning(f"⏳ Ingreso de las {hora} ({l['lineas']} líneas) pendiente, reintentando ({l['intentos']} intentos): {l['ultimo_error']}")
+        else: st.info(f"⏳ Ingreso de las {hora} ({l['lineas']} líneas) en cola de envío.")
+
+    lineas = diario.lineas(user_key, local_id)
+    if lineas:
         st.subheader("🛒 Pre-ingreso")
-        df_carrito = pd.DataFrame(st.session_state.carritos[user_key])
-        ed = st.data_editor(df_carrito, column_config={"id_producto": None, "Factor": None}, use_container_width=True, key=f"ed_{user_key}")
+        df_carrito = pd.DataFrame(lineas)
+        ed = st.data_editor(df_carrito, column_config={"id_producto": None, "Factor": None}, use_container_width=True, key=f"ed_{user_key}_{local_id}_{st.session_state.prod_search_key}")
+        if not ed.equals(df_carrito): diario.reemplazar_lineas(user_key, local_id, ed.to_dict(orient='records'))
         
         col_fin, col_del = st.columns(2)
         
@@ -245,14 +407,14 @@ def ingreso_inventario_pantalla(local_id, user_key):
                 st.warning("Confirmas que deseas ingresar las mercaderías?")
                 c_si, c_no = st.columns(2)
                 if c_si.button("✅ SÍ"):
-                    for r in ed.to_dict(orient='records'):
-                        supabase.table("movimientos_inventario").insert({
-                            "id_local": local_id, "id_producto": r['id_producto'],
-                            "cantidad": r['Cantidad'] * r['Factor'],
-                            "tipo_movimiento": "AJUSTE", "ubicacion": r['Ubicación']
-                        }).execute()
-                    st.success("Guardado.")
-                    st.session_state.carritos[user_key] = []
+                    # Queda en el diario local y se envía en segundo plano, con reintentos
+                    diario.confirmar(user_key, local_id, [{
+                        "id_local": local_id, "id_producto": r['id_producto'],
+                        "cantidad": r['Cantidad'] * r['Factor'],
+                        "tipo_movimiento": "AJUSTE", "ubicacion": r['Ubicación']
+                    } for r in ed.to_dict(orient='records')])
+                    despachador.avisar()
+                    st.toast("✅ Recibido, se está guardando.")
                     st.session_state.confirm_guardar = False
                     st.rerun()
                 if c_no.button("❌ NO"):
@@ -272,7 +434,7 @@ def ingreso_inventario_pantalla(local_id, user_key):
                 st.error("¿Confirmas que deseas descartar el inventario?")
                 v_si, v_no = st.columns(2)
                 if v_si.button("🗑️ SÍ, VACIAR"):
-                    st.session_state.carritos[user_key] = []
+                    diario.vaciar(user_key, local_id)
                     st.session_state.confirm_vaciar = False
                     st.rerun()
                 if v_no.button("🔙 VOLVER"):
@@ -283,116 +445,239 @@ def ingreso_inventario_pantalla(local_id, user_key):
 # ==========================================
 # PANTALLA AUDITORÍA
 # ==========================================
+@medir_pantalla
 def auditoria_pantalla(local_id):
     st.header("🔎 Módulo de Auditoría")
     st.info("Este módulo es de comparación temporal. Los datos no se guardan en la DB.")
     
-    if 'audit_list' not in st.session_state: st.session_state.audit_list = []
+    # Lista de comparación por id de producto: registrar o corregir una fila es O(1)
+    if not isinstance(st.session_state.get('audit_list'), dict): st.session_state.audit_list = {}
     if 'audit_search_key' not in st.session_state: st.session_state.audit_search_key = 1000
     
-    stock_actual = obtener_stock_dict(local_id)
-    res_prod = supabase.table("productos_maestro").select("*").execute().data
+    res = consultar_en_paralelo({"stock": lambda: obtener_stock_dict(local_id), "catalogo": cargar_catalogo})
+    stock_actual, catalogo = res["stock"], res["catalogo"]
     
-    if not res_prod:
+    if not catalogo["productos"]:
         st.warning("No hay productos en el maestro.")
         return
+    # Sin stock no se compara contra nada: se desactivan Registrar y Conciliar
+    sin_stock = stock_actual is None
+    if sin_stock: st.error(STOCK_NO_DISPONIBLE)
 
-    prod_map = {f"{p['nombre']} | {p['formato_medida']}": p for p in res_prod}
-    
-    with st.expander("➕ Añadir Producto a Revisión", expanded=True):
-        sel = st.selectbox("Selecciona producto:", [""] + sorted(list(prod_map.keys())), key=f"audit_sel_{st.session_state.audit_search_key}")
-        if sel:
-            p = prod_map[sel]
-            factor = extraer_valor_formato(p['formato_medida'])
-            stock_sistema = round(stock_actual.get(p['id'], 0) / factor, 2)
+    t_manual, t_masivo = st.tabs(["➕ Producto a producto", "📤 Conteo masivo"])
+    with t_manual:
+        p = selector_producto(catalogo, f"audit_sel_{st.session_state.audit_search_key}")
+        if p:
+            factor = p['factor']
+            stock_sistema = None if sin_stock else round(stock_actual.get(p['id'], 0) / factor, 2)
             
             c1, c2 = st.columns(2)
             cant_fisica = c1.number_input("Conteo Físico:", min_value=0.0, step=0.1, value=None)
             
-            if c2.button("Registrar Comparación"):
-                st.session_state.audit_list = [i for i in st.session_state.audit_list if i['id'] != p['id']]
-                
-                st.session_state.audit_list.append({
+            if c2.button("Registrar Comparación", disabled=sin_stock):
+                st.session_state.audit_list[p['id']] = {
                     "id": p['id'],
                     "Producto": p['nombre'],
                     "Formato": p['formato_medida'],
                     "Sistema": stock_sistema,
                     "Físico": cant_fisica if cant_fisica is not None else 0,
                     "Diferencia": round((cant_fisica if cant_fisica is not None else 0) - stock_sistema, 2)
-                })
+                }
                 st.session_state.audit_search_key += 1
                 st.rerun()
 
+    with t_masivo:
+        st.caption("Planilla CSV/XLSX con columnas SKU y Conteo (en unidades del formato).")
+        file = st.file_uploader("Conteo físico", type=["xlsx", "csv"], key="audit_file")
+        if file and st.button("Conciliar", disabled=sin_stock):
+            try:
+                with st.spinner("Conciliando..."):
+                    conteo, errores = leer_conteo(file)
+                    st.session_state.audit_masivo = dict(conciliar_conteo(catalogo["df"], stock_actual, conteo), errores=errores, local=local_id)
+            except ValueError as e: st.error(str(e))
+        res_m = st.session_state.get('audit_masivo')
+        if res_m and res_m["local"] == local_id:
+            contados = res_m["contados"]
+            con_dif = contados[contados['diferencia'] != 0]
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Contados", len(contados))
+            m2.metric("Con diferencia", len(con_dif))
+            m3.metric("Sin contar", len(res_m["sin_contar"]))
+            m4.metric("SKU desconocidos", len(res_m["desconocidos"]))
+            r1, r2, r3, r4 = st.tabs(["Diferencias", "Sin contar", "Desconocidos", "Filas con error"])
+            with r1: st.dataframe(con_dif.drop(columns=['id']), use_container_width=True, hide_index=True)
+            with r2: st.dataframe(res_m["sin_contar"].drop(columns=['id']), use_container_width=True, hide_index=True)
+            with r3: st.dataframe(res_m["desconocidos"], use_container_width=True, hide_index=True)
+            with r4: st.dataframe(res_m["errores"], use_container_width=True, hide_index=True)
+            b1, b3 = st.columns(2)
+            if b1.button("➕ Pasar diferencias a la lista"):
+                filas = con_dif.rename(columns={"nombre": "Producto", "formato_medida": "Formato", "sistema": "Sistema", "fisico": "Físico", "diferencia": "Diferencia"})
+                st.session_state.audit_list.update({r['id']: r for r in filas.drop(columns=['sku']).to_dict(orient='records')})
+                st.rerun()
+            if b3.button("🗑️ Descartar conteo"):
+                del st.session_state.audit_masivo
+                st.rerun()
+            boton_exportar("📥 Descargar conciliación", "conciliacion", lambda: exportar.trozos_df(contados.drop(columns=['id'])), "exp_conciliacion")
+
     if st.session_state.audit_list:
         st.subheader("📋 Lista de Comparación")
-        df_audit = pd.DataFrame(st.session_state.audit_list)
+        df_audit = pd.DataFrame(list(st.session_state.audit_list.values()))
         st.dataframe(df_audit.drop(columns=['id']), use_container_width=True, hide_index=True)
         
-        col_acc1, col_acc2 = st.columns(2)
-        if col_acc1.button("🗑️ Limpiar Lista"):
-            st.session_state.audit_list = []
+        if st.button("🗑️ Limpiar Lista"):
+            st.session_state.audit_list = {}
             st.rerun()
-            
-        csv = df_audit.to_csv(index=False).encode('utf-8')
-        col_acc2.download_button("📥 Descargar Reporte (CSV)", csv, "auditoria.csv", "text/csv")
+        boton_exportar("📥 Descargar Reporte", "auditoria", lambda: exportar.trozos_df(df_audit.drop(columns=['id'])), "exp_auditoria")
 
 # ==========================================
 # 7. PANTALLA: REPORTES
 # ==========================================
+@medir_pantalla
 def reportes_pantalla(local_id):
     st.header("📊 Reportes")
-    t1, t2 = st.tabs(["🕒 Historial", "📦 Stock Actual"])
+    # Pestañas con estado: solo se calcula la que está abierta
+    t1, t2, t3 = st.tabs(["🕒 Historial", "📦 Stock Actual", "📅 Stock a una Fecha"], key="rep_tabs", on_change="rerun")
     try:
-        query = supabase.table("movimientos_inventario").select("fecha_hora, tipo_movimiento, cantidad, ubicacion, productos_maestro(sku, nombre, formato_medida)").eq("id_local", local_id).execute().data
-        if not query:
-            st.info("No hay movimientos.")
-            return
-        df = pd.json_normalize(query)
+        # El catálogo lo usan las tres; el stock actual solo su pestaña
+        tareas = {"catalogo": cargar_catalogo}
+        if t2.open: tareas["stock"] = lambda: obtener_stock_dict(local_id)
+        res = consultar_en_paralelo(tareas)
+        stock, catalogo = res.get("stock"), res["catalogo"]
         with t1:
-            st.subheader("Historial")
-            df_h = df[['fecha_hora', 'productos_maestro.sku', 'productos_maestro.nombre', 'tipo_movimiento', 'cantidad', 'ubicacion']].copy()
-            st.dataframe(df_h, use_container_width=True)
+            if t1.open:
+                st.subheader("Historial")
+                f1, f2 = st.columns(2)
+                rango = f1.date_input("Fechas:", (datetime.now().date() - timedelta(days=30), datetime.now().date()))
+                with f2: prod = selector_producto(catalogo, "hist_prod", "Producto:")
+                f3, f4 = st.columns(2)
+                tipos = f3.multiselect("Tipo:", TIPOS_MOVIMIENTO)
+                ubis = f4.multiselect("Ubicación:", UBICACIONES)
+                filtros = {
+                    "desde": rango[0] if len(rango) > 0 else None, "hasta": rango[1] if len(rango) > 1 else None,
+                    "id_producto": prod['id'] if prod else None, "tipos": tipos, "ubicaciones": ubis
+                }
+                # Al cambiar filtros o sede se vuelve a la primera página
+                clave = repr((local_id, filtros))
+                if st.session_state.get('hist', {}).get('clave') != clave:
+                    st.session_state.hist = {"clave": clave, "cursores": [None]}
+                hist = st.session_state.hist
+                # Paginación por clave ((fecha_hora, id) descendente): cada página cuesta lo mismo sin importar el tamaño del historial
+                filas = repo.historial(local_id, filtros, hist["cursores"][-1], HISTORIAL_PAGINA + 1)
+                hay_mas = len(filas) > HISTORIAL_PAGINA
+                filas = filas[:HISTORIAL_PAGINA]
+                if filas: st.dataframe(df_movimientos(filas).drop(columns=['id']), use_container_width=True, hide_index=True)
+                else: st.info("No hay movimientos.")
+                p_ant, p_num, p_sig = st.columns([1, 1, 1])
+                if len(hist["cursores"]) > 1 and p_ant.button("⬅️ Anterior"):
+                    hist["cursores"].pop()
+                    st.rerun()
+                p_num.markdown(f"Página {len(hist['cursores'])}")
+                if hay_mas and p_sig.button("Siguiente ➡️"):
+                    hist["cursores"].append((filas[-1]['fecha_hora'], filas[-1]['id']))
+                    st.rerun()
+                # Exporta todas las páginas con los mismos filtros, no solo la visible
+                boton_exportar("📥 Exportar historial", "historial", lambda: exportar.trozos_historial(repo, local_id, filtros), "exp_historial")
         with t2:
-            st.subheader("Stock Actual")
-            df_s = df.groupby(['productos_maestro.sku', 'productos_maestro.nombre', 'productos_maestro.formato_medida'])['cantidad'].sum().reset_index()
-            df_s['Factor'] = df_s['productos_maestro.formato_medida'].apply(extraer_valor_formato)
-            df_s['Stock Neto'] = (df_s['cantidad'] / df_s['Factor']).round(2)
-            st.dataframe(df_s[['productos_maestro.sku', 'productos_maestro.nombre', 'Stock Neto']], use_container_width=True)
+            if t2.open:
+                st.subheader("Stock Actual")
+                if stock is None: st.warning(STOCK_NO_DISPONIBLE)
+                elif not stock:
+                    st.info("No hay movimientos.")
+                else:
+                    df_s = tabla_stock(catalogo["df"], stock)
+                    st.dataframe(df_s[['sku', 'nombre', 'Stock Neto']], use_container_width=True, hide_index=True)
+                    boton_exportar("📥 Exportar stock", "stock", lambda: exportar.trozos_df(df_s[['sku', 'nombre', 'Stock Neto']]), "exp_stock")
+        with t3:
+            if t3.open:
+                # Los saldos mensuales los mantiene un hilo aparte (MantenedorSaldos); aquí solo se leen
+                hoy = datetime.now().date()
+                fecha = st.date_input("Stock al cierre del día:", hoy.replace(day=1) - timedelta(days=1), max_value=hoy)
+                zona_fecha = st.container()
+                st.subheader("Ingresos por Mes")
+                meses = st.date_input("Meses:", (hoy.replace(day=1) - timedelta(days=150), hoy), key="mensual_meses")
+                tareas = {"stock_al": lambda: repo.stock_al(local_id, fecha)}
+                if len(meses) == 2: tareas["meses"] = lambda: repo.saldos_periodos(local_id, meses[0].replace(day=1), meses[1].replace(day=1))
+                res_f = consultar_en_paralelo(tareas)
+                with zona_fecha:
+                    df_f = tabla_stock(catalogo["df"], res_f["stock_al"])
+                    if df_f.empty: st.info("No hay movimientos hasta esa fecha.")
+                    else:
+                        st.dataframe(df_f[['sku', 'nombre', 'Stock Neto']], use_container_width=True, hide_index=True)
+                        boton_exportar("📥 Exportar stock a la fecha", f"stock_{fecha.isoformat()}", lambda: exportar.trozos_df(df_f[['sku', 'nombre', 'Stock Neto']]), "exp_stock_fecha")
+                if len(meses) == 2:
+                    detalle, ingresos = reporte_mensual(catalogo["df"], res_f["meses"])
+                    if detalle.empty: st.info("No hay movimientos en esos meses.")
+                    else:
+                        st.dataframe(ingresos, use_container_width=True)
+                        with st.expander("Detalle por mes"):
+                            st.dataframe(detalle, use_container_width=True, hide_index=True)
+                        boton_exportar("📥 Descargar detalle", "saldos_mensuales", lambda: exportar.trozos_df(detalle), "exp_mensual")
     except Exception as e: st.error(f"Error: {e}")
 
 # ==========================================
 # 8. PANTALLA: MAESTRO
 # ==========================================
+@medir_pantalla
 def admin_maestro(local_id):
     st.header("⚙️ Gestión de Maestro")
     with st.expander("📤 Importar Excel/CSV"):
         file = st.file_uploader("Archivo", type=["xlsx", "csv"])
         if file and st.button("Cargar"):
+            barra = st.progress(0.0, text="Importando...")
             try:
-                df_up = pd.read_csv(file) if file.name.endswith('.csv') else pd.read_excel(file)
-                mapeo = {"Número de artículo": "sku", "Descripción del artículo": "nombre", "Categoria": "categoria"}
-                df_up = df_up.rename(columns=mapeo)
-                if 'formato_medida' not in df_up.columns: df_up['formato_medida'] = "1 unidad"
-                df_final = df_up[['sku', 'nombre', 'categoria', 'formato_medida']]
-                supabase.table("productos_maestro").upsert(df_final.to_dict(orient='records'), on_conflict="sku").execute()
-                st.success("Éxito.")
-                st.rerun()
+                st.session_state.import_reporte = importar_catalogo(repo, file, LOTE_CHUNK, progreso=lambda x: barra.progress(x, text=f"Importando... {int(x * 100)}%"))
             except Exception as e: st.error(f"Error: {e}")
-    res = supabase.table("productos_maestro").select("*").execute().data
-    if res:
-        st_dict = obtener_stock_dict(local_id)
-        df_m = pd.DataFrame(res)
-        df_m['Stock'] = df_m.apply(lambda r: round(st_dict.get(r['id'], 0) / extraer_valor_formato(r['formato_medida']), 2), axis=1)
-        ed_m = st.data_editor(df_m, column_config={"id": None}, num_rows="dynamic", use_container_width=True)
+            finally: invalidar_catalogo()
+        if st.session_state.get('import_reporte'):
+            cargados, errores = st.session_state.import_reporte
+            st.success(f"{cargados} productos cargados.")
+            if not errores.empty:
+                st.error(f"{len(errores)} filas con errores.")
+                st.dataframe(errores, use_container_width=True, hide_index=True)
+                st.download_button("📥 Descargar errores (CSV)", errores.to_csv(index=False).encode('utf-8'), "errores_importacion.csv", "text/csv")
+    res = consultar_en_paralelo({"stock": lambda: obtener_stock_dict(local_id), "catalogo": cargar_catalogo})
+    catalogo, st_dict = res["catalogo"], res["stock"]
+    if catalogo["productos"]:
+        df_m = df_editable(catalogo["df"])
+        if st_dict is None: st.warning(STOCK_NO_DISPONIBLE)
+        else: df_m['Stock'] = columna_stock(df_m, st_dict)
+        ed_m = st.data_editor(df_m, column_config={"id": None, "factor": None}, num_rows="dynamic", use_container_width=True)
         if st.button("💾 Guardar Cambios"):
-            for _, row in ed_m.iterrows():
-                supabase.table("productos_maestro").upsert({"id": row['id'], "sku": row['sku'], "nombre": row['nombre'], "categoria": row['categoria'], "formato_medida": row['formato_medida']}).execute()
-            st.success("Actualizado.")
-            st.rerun()
+            st.session_state.maestro_diff = diff_maestro(df_m, ed_m)
+        if st.session_state.get('maestro_diff'):
+            nuevos, modificados, eliminados = st.session_state.maestro_diff
+            if nuevos.empty and modificados.empty and not eliminados:
+                st.info("No hay cambios.")
+                del st.session_state.maestro_diff
+                return
+            st.warning(f"Cambios a guardar: {len(nuevos)} nuevos, {len(modificados)} modificados, {len(eliminados)} eliminados.")
+            if not nuevos.empty:
+                with st.expander("Nuevos"): st.dataframe(nuevos, use_container_width=True, hide_index=True)
+            if not modificados.empty:
+                with st.expander("Modificados"): st.dataframe(modificados.drop(columns=['id']), use_container_width=True, hide_index=True)
+            if eliminados:
+                with st.expander("Eliminados"): st.dataframe(df_m[df_m['id'].isin(eliminados)][COLUMNAS_MAESTRO], use_container_width=True, hide_index=True)
+            c_si, c_no = st.columns(2)
+            if c_si.button("✅ Confirmar"):
+                barra = st.progress(0.0, text="Guardando...")
+                try:
+                    guardar_diff_maestro(repo, nuevos, modificados, eliminados, LOTE_CHUNK, progreso=lambda x: barra.progress(x, text=f"Guardando... {int(x * 100)}%"))
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                else:
+                    del st.session_state.maestro_diff
+                    st.success("Actualizado.")
+                    st.rerun()
+                finally:
+                    invalidar_catalogo()
+            if c_no.button("❌ Cancelar"):
+                del st.session_state.maestro_diff
+                st.rerun()
 
 # ==========================================
 # 9. PANTALLA: USUARIOS
 # ==========================================
+@medir_pantalla
 def admin_usuarios(locales_map):
     st.header("👤 Gestión de Usuarios")
     if 'u_mode' not in st.session_state: st.session_state.u_mode = None
@@ -411,10 +696,10 @@ def admin_usuarios(locales_map):
             l_id = locales_map[l_sel]
             if st.form_submit_button("Registrar"):
                 if nombre and user_log and pw and roles_asignados:
-                    supabase.table("usuarios_sistema").upsert({
+                    repo.upsert_usuario({
                         "nombre_apellido": nombre, "id_local": l_id, 
                         "usuario": user_log, "clave": pw, "rol": json.dumps(roles_asignados)
-                    }, on_conflict="usuario").execute()
+                    })
                     st.success("Registrado.")
                     st.session_state.u_mode = None
                     st.rerun()
@@ -422,7 +707,7 @@ def admin_usuarios(locales_map):
 
     st.markdown("---")
     try:
-        res_u = supabase.table("usuarios_sistema").select("*").execute().data
+        res_u = repo.listar_usuarios()
         if res_u:
             df_users = pd.DataFrame(res_u)
             locales_inv = {v: k for k, v in locales_map.items()}
@@ -435,10 +720,136 @@ def admin_usuarios(locales_map):
     except: pass
 
 # ==========================================
-# 10. MAIN
+# 10. PANTALLA: STOCK POR SEDE
 # ==========================================
+MATRIZ_MAX_FILAS = 2000  # filas que se pintan; la descarga lleva la matriz completa
+
+@medir_pantalla
+def stock_sedes_pantalla(locales_map):
+    st.header("🗺️ Stock por Sede")
+    c1, c2, c3 = st.columns(3)
+    por_ubicacion = c1.toggle("Separar por ubicación")
+    umbral = c2.number_input("Stock bajo si es menor a:", value=1.0, step=1.0)
+    solo_bajos = c3.toggle("Solo stock bajo o negativo")
+    try:
+        res = consultar_en_paralelo({"stock": lambda: obtener_stock_sedes(por_ubicacion), "catalogo": cargar_catalogo})
+        if res["stock"] is None:
+            # El cálculo sigue en segundo plano; el próximo intento lo encuentra avanzado o listo
+            st.warning("El stock de todas las sedes todavía se está calculando. Reintenta en unos segundos.")
+            return
+        matriz = matriz_stock(res["catalogo"]["df"], res["stock"], locales_map, por_ubicacion)
+    except Exception as e:
+        st.error(f"Error: {e}")
+        return
+    if matriz.empty:
+        st.info("No hay movimientos.")
+        return
+    sedes = [c for c in matriz.columns if c != 'Total']
+    f1, f2, f3 = st.columns(3)
+    texto = f1.text_input("Filtrar por nombre o SKU:")
+    cats = f2.multiselect("Categoría:", sorted(matriz.index.get_level_values('categoria').dropna().unique().tolist()))
+    sel_sedes = f3.multiselect("Sedes:", sedes)
+    o1, o2 = st.columns(2)
+    orden = o1.selectbox("Ordenar por:", ["nombre", "Total"] + sedes)
+    descendente = o2.toggle("Descendente")
+
+    df = matriz.reset_index()
+    if sel_sedes:
+        df = df.drop(columns=[c for c in sedes if c not in sel_sedes])
+        df['Total'] = df[sel_sedes].sum(axis=1).round(2)
+        sedes = sel_sedes
+    if texto:
+        t = texto.strip().lower()
+        df = df[df['nombre'].str.lower().str.contains(t, regex=False, na=False) | df['sku'].astype(str).str.lower().str.contains(t, regex=False, na=False)]
+    if cats: df = df[df['categoria'].isin(cats)]
+    if solo_bajos: df = df[(df[sedes] < umbral).any(axis=1)]
+    if orden in df.columns: df = df.sort_values(orden, ascending=not descendente, kind="stable")
+    df = df.drop(columns=['id'])
+
+    st.caption(f"{len(df):,} filas · {len(sedes)} sedes")
+    def resaltar(v):
+        if pd.isna(v): return ""
+        if v < 0: return "background-color: #5c1a1a; color: #ff6b6b"
+        if v < umbral: return "background-color: #5c4d00; color: #FFCC00"
+        return ""
+    vista = df.head(MATRIZ_MAX_FILAS)
+    st.dataframe(vista.style.map(resaltar, subset=sedes).format(precision=2, na_rep="–"), use_container_width=True, hide_index=True)
+    if len(df) > MATRIZ_MAX_FILAS: st.caption(f"Mostrando {MATRIZ_MAX_FILAS:,} de {len(df):,}; descarga la matriz para ver todo.")
+    boton_exportar("📥 Descargar matriz", "stock_por_sede", lambda: exportar.trozos_df(df), "exp_sedes")
+
+# ==========================================
+# 11. PANTALLA: COMPACTACIÓN
+# ==========================================
+@medir_pantalla
+def compactacion_pantalla():
+    st.header("🗜️ Compactación de Movimientos")
+    st.info("Los movimientos anteriores al corte se resumen en una fila SALDO_INICIAL por sede, producto y ubicación. "
+            "Los originales pasan al archivo y siguen contando para el stock a una fecha y los ingresos por mes.")
+    hoy = datetime.now().date()
+    corte = st.date_input("Compactar movimientos anteriores a:", hoy.replace(day=1, year=hoy.year - 1), max_value=hoy)
+    if st.session_state.get('compactar', {}).get('corte') != corte: st.session_state.compactar = {"corte": corte}
+    estado = st.session_state.compactar
+    if st.button("🔍 Revisar"): estado["previa"] = repo.previa_compactacion(corte)
+    if estado.get("previa"):
+        previa = estado["previa"]
+        if not previa["movimientos"]:
+            st.info("No hay movimientos anteriores a esa fecha.")
+            return
+        st.warning(f"Se archivarán {previa['movimientos']:,} movimientos y quedarán hasta {previa['saldos']:,} filas de saldo inicial.")
+        if st.button("✅ Compactar"):
+            with st.spinner("Compactando y verificando saldos..."):
+                try: res = repo.compactar_movimientos(corte)
+                except Exception as e:
+                    st.error(f"Error: {e}")
+                    return
+            # Los libros de stock (de este y de otros procesos) ven la compactación nueva y se rearman solos
+            del st.session_state.compactar
+            st.success(f"Listo: {res['movimientos']:,} movimientos archivados en {res['saldos']:,} saldos iniciales. El stock por sede no cambió.")
+
+# ==========================================
+# 12. PANTALLA: DIAGNÓSTICO
+# ==========================================
+@medir_pantalla
+def diagnostico_pantalla(locales_map):
+    st.header("🩺 Diagnóstico")
+    st.info("Tiempos de este servidor desde su último reinicio (últimos eventos en memoria).")
+    if SALDOS_INTERVALO and _mantenedor_saldos(repo).ultimo_error:
+        st.error(f"Saldos mensuales sin actualizar: {_mantenedor_saldos(repo).ultimo_error}")
+    df = metricas.eventos()
+    if df.empty:
+        st.warning("Aún no hay mediciones.")
+        return
+    locales_inv = {v: k for k, v in locales_map.items()}
+    df['sede'] = df['sede'].map(lambda x: locales_inv.get(x, x))
+    sedes = st.multiselect("Sedes:", sorted(df['sede'].dropna().unique().tolist()))
+    if sedes: df = df[df['sede'].isin(sedes)]
+    t1, t2, t3, t4 = st.tabs(["🔌 Consultas", "🖥️ Pantallas", "🔁 Por rerun", "📍 Por sede"])
+    with t1: st.dataframe(metricas.resumen(df[df['tipo'] == "consulta"]), use_container_width=True, hide_index=True)
+    with t2: st.dataframe(metricas.resumen(df[df['tipo'] == "pantalla"]), use_container_width=True, hide_index=True)
+    with t3:
+        reruns = metricas.por_rerun(df)
+        if not reruns.empty:
+            c1, c2, c3 = st.columns(3)
+            c1.metric("Reruns", len(reruns))
+            c2.metric("p50 backend (ms)", round(reruns['ms'].quantile(0.5), 1))
+            c3.metric("p95 backend (ms)", round(reruns['ms'].quantile(0.95), 1))
+            st.dataframe(reruns.sort_values('ms', ascending=False), use_container_width=True, hide_index=True)
+    with t4: st.dataframe(metricas.resumen(df, por=("sede", "tipo", "nombre")), use_container_width=True, hide_index=True)
+    c_exp, c_lim = st.columns(2)
+    c_exp.download_button("📥 Exportar eventos (CSV)", df.to_csv(index=False).encode('utf-8'), "diagnostico.csv", "text/csv")
+    if c_lim.button("🗑️ Reiniciar mediciones"):
+        metricas.limpiar()
+        st.rerun()
+
+# ==========================================
+# 13. MAIN
+# ==========================================
+PANTALLAS_CON_CATALOGO = ("📋 Ingreso", "📊 Reportes", "🔎 Auditoría", "⚙️ Maestro", "🗺️ Stock por Sede")
+
 def main():
     sync_session()
+    user = st.session_state.get('auth_user')
+    metricas.fijar_contexto(user['local'] if user else None, user['user'] if user else None)
     if 'auth_user' not in st.session_state:
         c_l1, c_l2, c_l3 = st.columns([1, 2, 1])
         with c_l2:
@@ -450,18 +861,20 @@ def main():
                     if u.lower() == "admin" and p == "654321.":
                         st.session_state.auth_user = {"user": "Master", "role": ["Admin"], "local": 1}
                         st.rerun()
-                    res = supabase.table("usuarios_sistema").select("*").eq("usuario", u).eq("clave", p).execute().data
+                    res = repo.buscar_usuario(u, p)
                     if res:
                         try: 
-                            roles = json.loads(res[0]['rol'])
+                            roles = json.loads(res['rol'])
                             if not isinstance(roles, list): roles = [roles]
-                        except: roles = [res[0]['rol']]
-                        st.session_state.auth_user = {"user": res[0]['usuario'], "role": roles, "local": res[0]['id_local']}
+                        except: roles = [res['rol']]
+                        st.session_state.auth_user = {"user": res['usuario'], "role": roles, "local": res['id_local']}
                         st.rerun()
                     else: st.error("Error de login.")
         return
 
     user = st.session_state.auth_user
+    if SALDOS_INTERVALO: _mantenedor_saldos(repo)
+    if st.session_state.get('opt') in PANTALLAS_CON_CATALOGO: precargar(cargar_catalogo)
     locales = get_locales_map()
     locales_inv = {v: k for k, v in locales.items()}
     
@@ -470,6 +883,7 @@ def main():
         idx = list(locales.keys()).index(actual_name)
         nueva_sede = st.sidebar.selectbox("Sede Activa:", list(locales.keys()), index=idx)
         user['local'] = locales[nueva_sede]
+        metricas.contexto.sede = user['local']
     
     st.sidebar.image("Logo AE.jpg", use_container_width=True)
     st.sidebar.markdown(f'<div class="user-info">👤 {user["user"]}<br>📍 {locales_inv.get(user["local"], "N/A")}</div>', unsafe_allow_html=True)
@@ -477,7 +891,7 @@ def main():
     menu_options = []
     if "Staff" in user['role'] or "Admin" in user['role']: menu_options.extend(["📋 Ingreso", "📊 Reportes"])
     if "Auditor" in user['role'] or "Admin" in user['role']: menu_options.append("🔎 Auditoría")
-    if "Admin" in user['role']: menu_options.extend(["👤 Usuarios", "⚙️ Maestro"])
+    if "Admin" in user['role']: menu_options.extend(["👤 Usuarios", "⚙️ Maestro", "🗺️ Stock por Sede", "🗜️ Compactación", "🩺 Diagnóstico"])
     
     menu = list(dict.fromkeys(menu_options))
     if 'opt' not in st.session_state or st.session_state.opt not in menu: st.session_state.opt = menu[0]
@@ -497,6 +911,9 @@ def main():
     elif st.session_state.opt == "🔎 Auditoría": auditoria_pantalla(user['local'])
     elif st.session_state.opt == "👤 Usuarios": admin_usuarios(locales)
     elif st.session_state.opt == "⚙️ Maestro": admin_maestro(user['local'])
+    elif st.session_state.opt == "🗺️ Stock por Sede": stock_sedes_pantalla(locales)
+    elif st.session_state.opt == "🗜️ Compactación": compactacion_pantalla()
+    elif st.session_state.opt == "🩺 Diagnóstico": diagnostico_pantalla(locales)
 
 if __name__ == "__main__":
     main()
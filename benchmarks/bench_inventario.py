@@ -0,0 +1,200 @@
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from repositorio import RepositorioSQLite
+import exportar
+from inventario import construir_catalogo, df_movimientos, df_compacto, TIPOS_STOCK_SEDES, nuevo_libro, actualizar_libro, columna_stock, tabla_stock, guardar_movimientos
+
+# ==========================================
+# BENCHMARKS DE RUTAS CRÍTICAS
+# ==========================================
+# Genera un tenant sintético en SQLite (se reutiliza entre corridas) y mide las rutas
+# calientes de la app. El resultado queda en JSON para comparar antes/después de un cambio:
+#
+#   python benchmarks/bench_inventario.py --salida antes.json
+#   python benchmarks/bench_inventario.py --sedes 5 --productos 5000 --movimientos 200000   # corrida rápida
+
+FORMATOS = [
+    "Caja {n} u", "Pack x{n}", "Bolsa {n} g", "{n} kg", "Botella {n} ml", "Display {n} x 12",
+    "Bidón {n} lt", "Saco {n} kg", "unidad", "Granel", "Bandeja {n} u", "Paquete {n} un",
+]
+CATEGORIAS = ["Lácteos", "Carnes", "Verduras", "Abarrotes", "Bebidas", "Limpieza", "Congelados", "Panadería"]
+UBICACIONES = ["Bodega", "Frío", "Cocina", "Producción"]
+LOTE_GENERACION = 200_000
+
+def generar_tenant(repo, sedes, productos, movimientos, semilla):
+    rng = np.random.default_rng(semilla)
+    con = repo.con
+    with con:
+        con.executemany("insert into locales (id, nombre) values (?, ?)", [(i, f"Sede {i:03d}") for i in range(1, sedes + 1)])
+        ns = rng.choice([1, 2, 4, 6, 10, 12, 20, 24, 25, 50, 100, 250, 500, 750, 1000], size=productos)
+        plantillas = rng.integers(0, len(FORMATOS), size=productos)
+        cats = rng.integers(0, len(CATEGORIAS), size=productos)
+        con.executemany(
+            "insert into productos_maestro (id, sku, nombre, categoria, formato_medida) values (?, ?, ?, ?, ?)",
+            [(i + 1, f"SKU{i + 1:07d}", f"Producto {i + 1}", CATEGORIAS[cats[i]], FORMATOS[plantillas[i]].format(n=ns[i])) for i in range(productos)])
+    inicio = datetime(2024, 1, 1)
+    segundos = int(timedelta(days=730).total_seconds())
+    populares = rng.permutation(productos) + 1
+    hechos = 0
+    while hechos < movimientos:
+        n = min(LOTE_GENERACION, movimientos - hechos)
+        locs = rng.integers(1, sedes + 1, size=n)
+        # Pocos productos concentran la mayoría de los movimientos, como en una cocina real
+        prods = populares[(rng.zipf(1.3, size=n) - 1) % productos]
+        cants = np.round(rng.gamma(2.0, 6.0, size=n), 2)
+        offs = np.sort(rng.integers(0, segundos, size=n))
+        ubis = rng.integers(0, len(UBICACIONES), size=n)
+        base = inicio + timedelta(seconds=segundos * hechos / movimientos)
+        with con:
+            con.executemany(
+                "insert into movimientos_inventario (fecha_hora, id_local, id_producto, cantidad, tipo_movimiento, ubicacion) values (?, ?, ?, ?, 'AJUSTE', ?)",
+                [((base + timedelta(seconds=int(o) * n / movimientos)).isoformat(), int(l), int(p), float(c), UBICACIONES[u])
+                 for l, p, c, o, u in zip(locs, prods, cants, offs, ubis)])
+        hechos += n
+        print(f"  movimientos: {hechos:,}/{movimientos:,}", file=sys.stderr)
+
+def filas_carrito(local_id, productos, n, rng):
+    id_lote = f"bench-{uuid.uuid4()}"
+    return [{
+        "id_local": local_id, "id_producto": int(p), "cantidad": float(c),
+        "tipo_movimiento": "AJUSTE", "ubicacion": "Bodega", "id_lote": id_lote, "linea": i
+    } for i, (p, c) in enumerate(zip(rng.integers(1, productos + 1, size=n), rng.integers(1, 50, size=n)))]
+
+def medir(nombre, preparar, repeticiones):
+    # preparar() devuelve la función a medir; se llama de nuevo para cada corrida
+    tiempos, filas = [], None
+    for _ in range(repeticiones):
+        fn = preparar()
+        gc.collect()
+        t0 = time.perf_counter()
+        res = fn()
+        tiempos.append(time.perf_counter() - t0)
+        filas = len(res) if hasattr(res, "__len__") else res
+    fn = preparar()
+    gc.collect()
+    tracemalloc.start()
+    fn()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    r = {"caso": nombre, "segundos": min(tiempos), "segundos_mediana": float(np.median(tiempos)),
+         "pico_mb": round(pico / 2**20, 2), "filas": filas, "repeticiones": repeticiones}
+    print(f"{nombre:28s} {r['segundos'] * 1000:10.1f} ms {r['pico_mb']:9.1f} MB  filas={filas}", file=sys.stderr)
+    return r
+
+def memoria(nombre, filas, ingenuo, compacto):
+    # MB de cada DataFrame (memory_usage deep), armado a la antigua y con tipos compactos
+    a = ingenuo(filas).memory_usage(deep=True).sum() / 2**20
+    b = compacto(filas).memory_usage(deep=True).sum() / 2**20
+    r = {"caso": nombre, "filas": len(filas), "mb_antes": round(a, 2), "mb_compacto": round(b, 2), "reduccion": round(a / b, 2) if b else None}
+    print(f"{nombre:28s} {a:10.1f} MB -> {b:8.1f} MB  x{r['reduccion']}  filas={len(filas):,}", file=sys.stderr)
+    return r
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmarks de rutas críticas del inventario")
+    ap.add_argument("--sedes", type=int, default=50)
+    ap.add_argument("--productos", type=int, default=50_000)
+    ap.add_argument("--movimientos", type=int, default=5_000_000)
+    ap.add_argument("--semilla", type=int, default=42)
+    ap.add_argument("--repeticiones", type=int, default=3)
+    ap.add_argument("--lineas-carrito", type=int, default=300)
+    ap.add_argument("--filas-memoria", type=int, default=1_000_000, help="movimientos para el reporte de memoria")
+    ap.add_argument("--db", help="ruta del SQLite sintético (por defecto benchmarks/datos/...)")
+    ap.add_argument("--salida", default="bench_resultados.json")
+    args = ap.parse_args()
+
+    ruta = args.db or os.path.join(os.path.dirname(os.path.abspath(__file__)), "datos",
+                                   f"tenant_{args.sedes}_{args.productos}_{args.movimientos}_{args.semilla}.db")
+    os.makedirs(os.path.dirname(ruta), exist_ok=True)
+    nuevo = not os.path.exists(ruta)
+    repo = RepositorioSQLite(ruta)
+    if nuevo:
+        print(f"Generando tenant sintético en {ruta}", file=sys.stderr)
+        generar_tenant(repo, args.sedes, args.productos, args.movimientos, args.semilla)
+    # Restos de una corrida interrumpida
+    with repo.con: repo.con.execute("delete from movimientos_inventario where id_lote like 'bench-%'")
+
+    rng = np.random.default_rng(args.semilla)
+    local_id = repo._consultar("select id_local from movimientos_inventario group by id_local order by count(*) desc limit 1")[0]['id_local']
+    productos = repo.listar_productos()
+    catalogo = construir_catalogo([dict(p) for p in productos])
+    stock = actualizar_libro(repo, nuevo_libro(), local_id)
+    while repo.actualizar_saldos(): pass
+    rep = args.repeticiones
+
+    def libro_incremental():
+        libro = nuevo_libro()
+        actualizar_libro(repo, libro, local_id)
+        repo.insertar_movimientos(filas_carrito(local_id, args.productos, args.lineas_carrito, rng))
+        return lambda: actualizar_libro(repo, libro, local_id)
+
+    def exportacion(formato):
+        # Pico de memoria plano: no depende de cuántos movimientos tenga la sede ("filas" = bytes del archivo)
+        def correr():
+            f = exportar.exportar(exportar.trozos_historial(repo, local_id, {}), formato)
+            f.seek(0, os.SEEK_END)
+            tam = f.tell()
+            f.close()
+            return tam
+        return lambda: correr
+
+    def carrito_reintento():
+        filas = filas_carrito(local_id, args.productos, args.lineas_carrito, rng)
+        guardar_movimientos(repo, filas, 200)
+        return lambda: guardar_movimientos(repo, filas, 200) or len(filas)
+
+    resultados = [
+        medir("catalogo_carga", lambda: repo.listar_productos, rep),
+        medir("catalogo_indice", lambda: lambda: construir_catalogo([dict(p) for p in productos])["productos"], rep),
+        medir("busqueda_prefijo_corto", lambda: lambda: catalogo["indice"].buscar("pro", 20), rep),
+        medir("busqueda_sku", lambda: lambda: catalogo["indice"].buscar(productos[-1]['sku'], 20), rep),
+        medir("stock_libro_completo", lambda: lambda: actualizar_libro(repo, nuevo_libro(), local_id), rep),
+        medir("stock_libro_incremental", libro_incremental, rep),
+        medir("stock_agregado_servidor", lambda: lambda: repo.stock_agregado(local_id), rep),
+        medir("stock_al_fecha", lambda: lambda: repo.stock_al(local_id, date(2025, 6, 15)), rep),
+        medir("reportes_tabla_stock", lambda: lambda: tabla_stock(catalogo["df"], stock), rep),
+        medir("maestro_columna_stock", lambda: lambda: columna_stock(catalogo["df"], stock), rep),
+        *[medir(f"exportar_historial_{formato.split()[0].lower()}", exportacion(formato), rep) for formato in exportar.FORMATOS],
+        medir("carrito_guardar", lambda: (lambda f: lambda: guardar_movimientos(repo, f, 200) or len(f))(
+            filas_carrito(local_id, args.productos, args.lineas_carrito, rng)), rep),
+        medir("carrito_reintento_idempotente", carrito_reintento, rep),
+    ]
+    with repo.con: repo.con.execute("delete from movimientos_inventario where id_lote like 'bench-%'")
+
+    print("Memoria de DataFrames:", file=sys.stderr)
+    historial = repo.historial(local_id, {}, None, args.filas_memoria)
+    memorias = [
+        memoria("catalogo", [dict(p) for p in productos], pd.DataFrame, lambda f: construir_catalogo(f)["df"]),
+        memoria("historial", historial, pd.json_normalize, df_movimientos),
+        memoria("stock_por_sede", repo.stock_por_sede(True), pd.DataFrame,
+                lambda f: df_compacto({c: [r[c] for r in f] for c in TIPOS_STOCK_SEDES}, TIPOS_STOCK_SEDES)),
+    ]
+    del historial
+
+    salida = {
+        "fecha": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "plataforma": platform.platform(),
+        "dataset": {"sedes": args.sedes, "productos": args.productos, "movimientos": args.movimientos,
+                    "semilla": args.semilla, "db": ruta, "id_local_medido": local_id},
+        "resultados": resultados,
+        "memoria": memorias,
+    }
+    with open(args.salida, "w", encoding="utf-8") as f:
+        json.dump(salida, f, indent=2, ensure_ascii=False)
+    print(f"Resultados en {args.salida}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
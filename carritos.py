@@ -0,0 +1,140 @@
+import json
+import sqlite3
+import threading
+import time
+import uuid
+
+from inventario import guardar_movimientos
+
+# ==========================================
+# CARRITOS PERSISTENTES
+# ==========================================
+# Las líneas del carrito se guardan en un SQLite local apenas se agregan, por usuario y sede,
+# así sobreviven a una desconexión o a un reinicio del servidor. Al confirmar, el carrito pasa
+# a ser un lote pendiente que el Despachador envía a movimientos_inventario en segundo plano.
+
+ESQUEMA_DIARIO = """
+create table if not exists lineas (
+    id integer primary key autoincrement,
+    usuario text not null,
+    id_local integer not null,
+    datos text not null,
+    creado real not null
+);
+create index if not exists idx_lineas_usuario_local on lineas (usuario, id_local, id);
+create table if not exists lotes (
+    id_lote text primary key,
+    usuario text not null,
+    id_local integer not null,
+    filas text not null,
+    estado text not null default 'pendiente',
+    intentos integer not null default 0,
+    ultimo_error text,
+    proximo_intento real not null default 0,
+    creado real not null,
+    enviado real
+);
+create index if not exists idx_lotes_estado on lotes (estado, proximo_intento);
+"""
+
+ESPERA_MAX = 300  # segundos entre reintentos de un lote que sigue fallando
+RETENCION_ENVIADOS = 7 * 24 * 3600
+
+class DiarioCarritos:
+    def __init__(self, ruta):
+        self.con = sqlite3.connect(ruta, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute("pragma journal_mode=wal")
+            self.con.executescript(ESQUEMA_DIARIO)
+
+    # --- carrito en curso ---
+    def lineas(self, usuario, id_local):
+        with self.lock:
+            res = self.con.execute("select datos from lineas where usuario = ? and id_local = ? order by id", (usuario, id_local)).fetchall()
+        return [json.loads(r['datos']) for r in res]
+
+    def agregar_linea(self, usuario, id_local, datos):
+        with self.lock, self.con:
+            self.con.execute("insert into lineas (usuario, id_local, datos, creado) values (?, ?, ?, ?)", (usuario, id_local, json.dumps(datos), time.time()))
+
+    def reemplazar_lineas(self, usuario, id_local, lineas):
+        with self.lock, self.con:
+            self.con.execute("delete from lineas where usuario = ? and id_local = ?", (usuario, id_local))
+            self.con.executemany("insert into lineas (usuario, id_local, datos, creado) values (?, ?, ?, ?)",
+                                 [(usuario, id_local, json.dumps(l), time.time()) for l in lineas])
+
+    def vaciar(self, usuario, id_local):
+        self.reemplazar_lineas(usuario, id_local, [])
+
+    def confirmar(self, usuario, id_local, filas):
+        # El lote y el vaciado del carrito van en la misma transacción
+        id_lote = str(uuid.uuid4())
+        filas = [dict(f, id_lote=id_lote, linea=n) for n, f in enumerate(filas)]
+        with self.lock, self.con:
+            self.con.execute("insert into lotes (id_lote, usuario, id_local, filas, creado) values (?, ?, ?, ?, ?)",
+                             (id_lote, usuario, id_local, json.dumps(filas), time.time()))
+            self.con.execute("delete from lineas where usuario = ? and id_local = ?", (usuario, id_local))
+        return id_lote
+
+    # --- lotes ---
+    def pendientes(self):
+        with self.lock:
+            res = self.con.execute("select id_lote, filas from lotes where estado = 'pendiente' and proximo_intento <= ? order by creado", (time.time(),)).fetchall()
+        return [{"id_lote": r['id_lote'], "filas": json.loads(r['filas'])} for r in res]
+
+    def marcar_enviados(self, ids):
+        with self.lock, self.con:
+            self.con.executemany("update lotes set estado = 'enviado', enviado = ?, ultimo_error = null where id_lote = ?", [(time.time(), i) for i in ids])
+            self.con.execute("delete from lotes where estado = 'enviado' and enviado < ?", (time.time() - RETENCION_ENVIADOS,))
+
+    def marcar_error(self, id_lote, error):
+        with self.lock, self.con:
+            self.con.execute(
+                "update lotes set intentos = intentos + 1, ultimo_error = ?, proximo_intento = ? + min(?, 5 * (1 << min(intentos, 10))) where id_lote = ?",
+                (error[:500], time.time(), ESPERA_MAX, id_lote))
+
+    def estado_lotes(self, usuario, id_local):
+        with self.lock:
+            res = self.con.execute(
+                "select id_lote, estado, intentos, ultimo_error, creado, json_array_length(filas) as lineas from lotes "
+                "where usuario = ? and id_local = ? and (estado = 'pendiente' or enviado > ?) order by creado desc",
+                (usuario, id_local, time.time() - 3600)).fetchall()
+        return [dict(r) for r in res]
+
+
+class Despachador(threading.Thread):
+    # Hilo único por proceso que envía los lotes confirmados
+    def __init__(self, diario, repo, tam, intervalo=5):
+        super().__init__(daemon=True, name="despachador-carritos")
+        self.diario, self.repo, self.tam, self.intervalo = diario, repo, tam, intervalo
+        self.evento = threading.Event()
+
+    def avisar(self):
+        self.evento.set()
+
+    def run(self):
+        while True:
+            self.evento.wait(self.intervalo)
+            self.evento.clear()
+            try: self.enviar_pendientes()
+            except Exception: pass
+
+    def enviar_pendientes(self):
+        lotes = self.diario.pendientes()
+        if not lotes: return
+        # Primero todos juntos en inserts por trozos; si falla, lote por lote para aislar al que falla.
+        # Reenviar es seguro: (id_lote, linea) descarta lo que ya se guardó.
+        if len(lotes) > 1:
+            try:
+                guardar_movimientos(self.repo, [f for l in lotes for f in l["filas"]], self.tam)
+                self.diario.marcar_enviados([l["id_lote"] for l in lotes])
+                return
+            except Exception: pass
+        for l in lotes:
+            try:
+                guardar_movimientos(self.repo, l["filas"], self.tam)
+                self.diario.marcar_enviados([l["id_lote"]])
+            except Exception as e:
+                self.diario.marcar_error(l["id_lote"], str(e))
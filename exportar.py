@@ -0,0 +1,101 @@
+import os
+import tempfile
+
+import openpyxl
+import pandas as pd
+
+from inventario import df_movimientos
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet es opcional
+    pa = pq = None
+
+# ==========================================
+# EXPORTACIONES POR TROZOS
+# ==========================================
+# Los datos llegan como un generador de DataFrames (una página de la consulta por vez) y se
+# escriben de a uno a un archivo temporal: la memoria no crece con el tamaño de la exportación.
+
+PAGINA_EXPORT = 1000  # filas por página de consulta (max-rows de PostgREST)
+MAX_FILAS_HOJA = 1_048_575  # límite de Excel sin la cabecera; se sigue en otra hoja
+
+FORMATOS = {
+    "CSV": (".csv", "text/csv"),
+    "Excel (XLSX)": (".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+}
+if pq is not None: FORMATOS["Parquet"] = (".parquet", "application/vnd.apache.parquet")
+
+def trozos_historial(repo, local_id, filtros, pagina=PAGINA_EXPORT):
+    # Paginación por clave, igual que la pantalla: cada página cuesta lo mismo
+    cursor = None
+    while True:
+        filas = repo.historial(local_id, filtros, cursor, pagina)
+        if not filas:
+            if cursor is None: yield df_movimientos([])  # sin movimientos: al menos la cabecera
+            return
+        yield df_movimientos(filas)
+        if len(filas) < pagina: return
+        cursor = (filas[-1]['fecha_hora'], filas[-1]['id'])
+
+def trozos_df(df, tam=PAGINA_EXPORT * 10):
+    for i in range(0, len(df), tam): yield df.iloc[i:i + tam]
+
+def _csv(trozos, f):
+    cabecera = True
+    for df in trozos:
+        df.to_csv(f, header=cabecera, index=False)
+        cabecera = False
+        yield len(df)
+
+def _xlsx(trozos, f):
+    # write_only no guarda las filas en memoria: se van volcando al zip
+    wb = openpyxl.Workbook(write_only=True)
+    hojas = []
+    def nueva_hoja(columnas):
+        ws = wb.create_sheet("Datos" if not hojas else f"Datos {len(hojas) + 1}")
+        ws.append(list(columnas))
+        hojas.append(ws)
+        return ws, 0
+    for df in trozos:
+        if not hojas: ws, en_hoja = nueva_hoja(df.columns)
+        # float32 -> texto -> float: en la celda queda 1.1 y no 1.100000023841858
+        for c in df.columns[df.dtypes == "float32"]: df[c] = df[c].astype("str").astype("float64")
+        for fila in df.astype(object).where(df.notna(), None).itertuples(index=False, name=None):
+            if en_hoja == MAX_FILAS_HOJA: ws, en_hoja = nueva_hoja(df.columns)
+            ws.append(fila)
+            en_hoja += 1
+        yield len(df)
+    if not hojas: wb.create_sheet("Datos")
+    wb.save(f)
+
+def _parquet(trozos, f):
+    escritor = None
+    try:
+        for df in trozos:
+            # Cada trozo trae sus propias categorías; Parquet ya codifica por diccionario al escribir
+            df = df.astype({c: "str" for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+            tabla = pa.Table.from_pandas(df, preserve_index=False)
+            if escritor is None: escritor = pq.ParquetWriter(f, tabla.schema)
+            escritor.write_table(tabla.cast(escritor.schema))
+            yield len(df)
+    finally:
+        if escritor is not None: escritor.close()
+
+ESCRITORES = {"CSV": _csv, "Excel (XLSX)": _xlsx, "Parquet": _parquet}
+
+def exportar(trozos, formato, progreso=None):
+    # Devuelve el archivo listo para leer; ya está desvinculado del disco y se borra al cerrarlo
+    sufijo, _ = FORMATOS[formato]
+    modo = "w" if formato == "CSV" else "w+b"
+    fd, ruta = tempfile.mkstemp(prefix="inventario_export_", suffix=sufijo)
+    try:
+        with open(fd, modo, encoding="utf-8-sig" if formato == "CSV" else None, newline="" if formato == "CSV" else None) as f:
+            total = 0
+            for n in ESCRITORES[formato](trozos, f):
+                total += n
+                if progreso: progreso(total)
+        return open(ruta, "rb")
+    finally:
+        os.remove(ruta)
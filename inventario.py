@@ -0,0 +1,439 @@
+import re
+import threading
+import time
+import unicodedata
+import heapq
+from bisect import bisect_left
+import numpy as np
+import pandas as pd
+import openpyxl
+
+# ==========================================
+# LÓGICA DE INVENTARIO (sin Streamlit)
+# ==========================================
+# Cálculos y escrituras que usan las pantallas de app.py. Reciben el repositorio como
+# parámetro para poder ejecutarse y medirse fuera de Streamlit (ver benchmarks/).
+
+COLUMNAS_MAESTRO = ['sku', 'nombre', 'categoria', 'formato_medida']
+
+def con_reintentos(fn, intentos=4, espera=0.5):
+    for i in range(intentos):
+        try: return fn()
+        except Exception:
+            if i == intentos - 1: raise
+            time.sleep(espera * 2 ** i)
+
+def trozos(items, tam):
+    return [items[i:i + tam] for i in range(0, len(items), tam)]
+
+def registros(df):
+    # NaN no es JSON válido para la API
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+# ==========================================
+# DATAFRAMES COMPACTOS
+# ==========================================
+# Los DataFrames se arman columna por columna con tipos explícitos: categorías para los textos
+# que se repiten, enteros de 32 bits para ids de catálogo y sede, float32 para cantidades de
+# movimientos y fechas ya parseadas. Las sumas de stock siguen en float64.
+TIPOS_CATALOGO = {"id": "int32", "sku": "str", "nombre": "str", "categoria": "category", "formato_medida": "category"}
+TIPOS_MOVIMIENTOS = {
+    "id": "int64", "fecha_hora": "fecha", "sku": "category", "nombre": "category",
+    "tipo_movimiento": "category", "cantidad": "float32", "ubicacion": "category",
+}
+TIPOS_STOCK_SEDES = {"id_local": "int32", "id_producto": "int32", "ubicacion": "category", "cantidad": "float64"}
+
+def _columna(valores, tipo):
+    if tipo is None: return pd.Series(valores, dtype=object)
+    if tipo == "category": return pd.Categorical(valores)
+    # Supabase devuelve UTC con offset, SQLite sin offset: ambos quedan como hora UTC sin zona
+    if tipo == "fecha": return pd.to_datetime(pd.Series(valores, dtype=object), format="ISO8601", utc=True).dt.tz_localize(None)
+    return pd.Series(valores, dtype=tipo)
+
+def df_compacto(columnas, tipos):
+    # columnas: {nombre: lista de valores}; las que no están en tipos quedan como object
+    return pd.DataFrame({c: _columna(v, tipos.get(c)) for c, v in columnas.items()})
+
+def df_movimientos(filas):
+    # Filas de repo.historial, con productos_maestro embebido, sin pasar por json_normalize
+    prods = [r.get('productos_maestro') or {} for r in filas]
+    columnas = {c: [r.get(c) for r in filas] for c in TIPOS_MOVIMIENTOS if c not in ('sku', 'nombre')}
+    columnas['sku'] = [p.get('sku') for p in prods]
+    columnas['nombre'] = [p.get('nombre') for p in prods]
+    return df_compacto({c: columnas[c] for c in TIPOS_MOVIMIENTOS}, TIPOS_MOVIMIENTOS)
+
+def df_editable(df):
+    # El editor de Streamlit trata las categorías como listas cerradas
+    return df.astype({c: object for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)})
+
+# ==========================================
+# FACTORES Y CATÁLOGO
+# ==========================================
+# formato_medida -> factor. El módulo se importa una vez por proceso, así que el memo
+# sobrevive a los reruns y se comparte entre sesiones.
+_FACTORES = {}
+
+def factores_formato(serie):
+    if isinstance(serie.dtype, pd.CategoricalDtype):
+        # Un cálculo por categoría; el código -1 (vacío) toma el factor de ""
+        por_cat = np.append(factores_formato(pd.Series(serie.cat.categories.astype(str))).to_numpy(), extraer_valor_formato(""))
+        return pd.Series(por_cat[serie.cat.codes.to_numpy()], index=serie.index)
+    textos = serie.fillna("").astype(str)
+    nuevos = [t for t in textos.unique() if t not in _FACTORES]
+    if nuevos:
+        # Una sola pasada de regex por texto distinto, no por fila
+        extraidos = pd.Series(nuevos).str.extract(r"(\d+)", expand=False)
+        _FACTORES.update(zip(nuevos, pd.to_numeric(extraidos).fillna(1).astype(int).tolist()))
+    return textos.map(_FACTORES)
+
+def extraer_valor_formato(formato_str):
+    texto = str(formato_str)
+    if texto not in _FACTORES:
+        match = re.search(r"(\d+)", texto)
+        _FACTORES[texto] = int(match.group(1)) if match else 1
+    return _FACTORES[texto]
+
+def construir_catalogo(productos):
+    claves = dict.fromkeys([*TIPOS_CATALOGO, *(k for p in productos[:1] for k in p)])
+    df = df_compacto({c: [p.get(c) for p in productos] for c in claves}, TIPOS_CATALOGO)
+    df['factor'] = factores_formato(df['formato_medida']).astype('int32')
+    for p, f in zip(productos, df['factor'].tolist()): p['factor'] = f
+    prod_map = {f"{p['nombre']} | {p['formato_medida']}": p for p in productos}
+    return {"productos": productos, "df": df, "prod_map": prod_map, "indice": IndiceBusqueda(prod_map)}
+
+# ==========================================
+# BÚSQUEDA DE PRODUCTOS
+# ==========================================
+# Campos de código que se buscan por coincidencia exacta (el SKU también se indexa por prefijo)
+CAMPOS_CODIGO = ("sku", "codigo_barras")
+
+def plegar(texto):
+    # Sin tildes ni mayúsculas: "Jamón" y "jamon" son lo mismo
+    texto = unicodedata.normalize("NFKD", str(texto))
+    return "".join(c for c in texto if not unicodedata.combining(c)).lower()
+
+def _tokens(texto):
+    return re.findall(r"\w+", plegar(texto))
+
+class IndiceBusqueda:
+    # Índice invertido sobre las etiquetas del catálogo. Los tokens quedan ordenados para
+    # resolver prefijos con bisect, sin guardar cada prefijo por separado.
+    def __init__(self, prod_map):
+        self.etiquetas = list(prod_map.keys())
+        self.codigos = {}
+        self.tokens_por_id = []
+        postings = {}
+        for i, (etiqueta, p) in enumerate(prod_map.items()):
+            tokens = frozenset(_tokens(etiqueta) + _tokens(p.get('sku') or ""))
+            self.tokens_por_id.append(tokens)
+            for t in tokens:
+                postings.setdefault(t, []).append(i)
+            for campo in CAMPOS_CODIGO:
+                if p.get(campo): self.codigos.setdefault(plegar(p[campo]).strip(), i)
+        self.tokens = sorted(postings)
+        self.postings = postings
+        self.plegadas = [plegar(e) for e in self.etiquetas]
+
+    def _con_prefijo(self, prefijo):
+        ids = set()
+        i = bisect_left(self.tokens, prefijo)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefijo):
+            ids.update(self.postings[self.tokens[i]])
+            i += 1
+        return ids
+
+    def buscar(self, consulta, k=20):
+        q = plegar(consulta).strip()
+        if not q: return []
+        exacto = self.codigos.get(q)
+        terminos = _tokens(q)
+        ids = None
+        for t in terminos:
+            ids = self._con_prefijo(t) if ids is None else ids & self._con_prefijo(t)
+            if not ids: break
+        ids = ids or set()
+        if exacto is not None: ids.add(exacto)
+        completos = set(terminos)
+        def orden(i):
+            e = self.plegadas[i]
+            return (i != exacto, -len(completos & self.tokens_por_id[i]), not e.startswith(q), len(e), e)
+        return [self.etiquetas[i] for i in heapq.nsmallest(k, ids, key=orden)]
+
+# ==========================================
+# STOCK
+# ==========================================
+# Los ids de una secuencia no se confirman en orden: una transacción lenta puede guardar ids menores
+# a otros ya leídos. ultimo_id es una marca segura (todo lo anterior ya está sumado y no llegará nada
+# más); lo posterior se relee en cada llamada y lo ya sumado se descarta por id (vistos).
+RETRASO_LIBRO = 120     # segundos tras los cuales una inserción en curso ya terminó
+VENTANA_LIBRO = 5_000   # ids que se releen como máximo detrás del mayor leído
+
+def nuevo_libro():
+    return {"ultimo_id": 0, "tope": 0, "vistos": set(), "marcas": [], "stock": {}, "generacion": None, "creado": time.time()}
+
+def _avanzar_marca(libro, retraso, ventana):
+    # (t, tope): a los `retraso` segundos de ver ese tope, todo id menor ya está confirmado y leído
+    ahora = time.monotonic()
+    if not libro["marcas"] or libro["marcas"][-1][1] < libro["tope"]: libro["marcas"].append((ahora, libro["tope"]))
+    seguras = [m for t, m in libro["marcas"] if t <= ahora - retraso]
+    marca = max([libro["ultimo_id"], libro["tope"] - ventana, *seguras])
+    libro["marcas"] = [(t, m) for t, m in libro["marcas"] if t > ahora - retraso]
+    if marca > libro["ultimo_id"]:
+        libro["ultimo_id"] = marca
+        libro["vistos"] = {i for i in libro["vistos"] if i > marca}
+
+def _sumar_desde_checkpoint(repo, libro, leer, clave, pagina, retraso=RETRASO_LIBRO, ventana=VENTANA_LIBRO):
+    # Una compactación (de este u otro proceso) archiva movimientos ya sumados y los repite como
+    # SALDO_INICIAL con ids nuevos: si la generación cambió antes o durante la lectura, se rehace
+    while True:
+        generacion = repo.generacion_movimientos()
+        if libro["generacion"] != generacion:
+            libro.update(ultimo_id=0, tope=0, vistos=set(), marcas=[], stock={}, generacion=generacion)
+        desde, stock, vistos = libro["ultimo_id"], libro["stock"], libro["vistos"]
+        while True:
+            res = leer(desde, pagina)
+            if not res: break
+            for r in res:
+                if r['id'] in vistos: continue
+                vistos.add(r['id'])
+                k = clave(r)
+                stock[k] = stock.get(k, 0) + (r['cantidad'] or 0)
+            desde = res[-1]['id']
+            if len(res) < pagina: break
+        if repo.generacion_movimientos() != generacion: continue
+        libro["tope"] = max(libro["tope"], desde)
+        _avanzar_marca(libro, retraso, ventana)
+        return stock
+
+def actualizar_libro(repo, libro, local_id, pagina=1000):
+    # Solo se descargan los movimientos posteriores al checkpoint
+    return _sumar_desde_checkpoint(repo, libro, lambda desde, n: repo.movimientos_desde(local_id, desde, n),
+                                   lambda r: r['id_producto'], pagina)
+
+def actualizar_libro_global(repo, libro, pagina=1000):
+    # Igual que actualizar_libro pero para todas las sedes: clave (id_local, id_producto, ubicacion)
+    return _sumar_desde_checkpoint(repo, libro, repo.movimientos_todas_desde,
+                                   lambda r: (r['id_local'], r['id_producto'], r['ubicacion']), pagina)
+
+def filas_libro_global(stock, por_ubicacion=False):
+    # Mismo formato que repo.stock_por_sede
+    if por_ubicacion:
+        return [{"id_local": l, "id_producto": p, "ubicacion": u, "cantidad": c} for (l, p, u), c in stock.items()]
+    suma = {}
+    for (l, p, _), c in stock.items(): suma[(l, p)] = suma.get((l, p), 0) + c
+    return [{"id_local": l, "id_producto": p, "ubicacion": None, "cantidad": c} for (l, p), c in suma.items()]
+
+def matriz_stock(df_catalogo, filas, locales_map, por_ubicacion=False):
+    # Producto (x ubicación) en filas, sedes en columnas, stock neto en unidades de formato
+    nombres_sede = {v: k for k, v in locales_map.items()}
+    indice = ['id', 'sku', 'nombre', 'categoria'] + (['ubicacion'] if por_ubicacion else [])
+    if not filas or df_catalogo.empty: return pd.DataFrame(columns=indice + ['Total']).set_index(indice)
+    m = df_compacto({c: [f.get(c) for f in filas] for c in TIPOS_STOCK_SEDES}, TIPOS_STOCK_SEDES)
+    m = m.merge(df_catalogo[['id', 'sku', 'nombre', 'categoria', 'factor']], left_on='id_producto', right_on='id')
+    m['neto'] = (m['cantidad'].astype(float) / m['factor']).round(2)
+    m['sede'] = m['id_local'].map(nombres_sede).fillna(m['id_local'].astype(str))
+    if por_ubicacion: m['ubicacion'] = m['ubicacion'].cat.add_categories("(sin ubicación)").fillna("(sin ubicación)")
+    t = m.pivot_table(index=indice, columns='sede', values='neto', aggfunc='sum', dropna=False, observed=True)
+    t = t.dropna(how='all')
+    t.columns.name = None
+    t['Total'] = t.sum(axis=1).round(2)
+    return t
+
+def columna_stock(df_catalogo, stock):
+    return (df_catalogo['id'].map(stock).fillna(0) / df_catalogo['factor']).round(2)
+
+def tabla_stock(df_catalogo, stock):
+    # Solo productos con movimientos en la sede
+    df_s = df_catalogo[['id', 'sku', 'nombre', 'factor']].copy()
+    df_s['cantidad'] = df_s['id'].map(stock)
+    df_s = df_s[df_s['cantidad'].notna()]
+    df_s['Stock Neto'] = (df_s['cantidad'] / df_s['factor']).round(2)
+    return df_s
+
+def reporte_mensual(df_catalogo, filas):
+    # Detalle por mes y producto (apertura, entradas, salidas, cierre) e ingresos mes a mes.
+    # Los movimientos que guarda la app son ingresos (AJUSTE >= 0): no hay salidas de las que sacar
+    # un consumo, así que la comparación mensual se hace sobre lo ingresado.
+    cols = ['periodo', 'sku', 'nombre', 'apertura', 'entradas', 'salidas', 'cierre']
+    if not filas or df_catalogo.empty: return pd.DataFrame(columns=cols), pd.DataFrame()
+    d = pd.DataFrame(filas).merge(df_catalogo[['id', 'sku', 'nombre', 'factor']], left_on='id_producto', right_on='id')
+    d['periodo'] = d['periodo'].astype(str).str[:7]
+    for c in ('entradas', 'salidas', 'saldo'): d[c] = d[c].astype(float) / d['factor']
+    d['apertura'] = d['saldo'] - d['entradas'] - d['salidas']
+    d['cierre'] = d['saldo']
+    detalle = d[cols].round(2)
+    ingresos = d.pivot_table(index=['sku', 'nombre'], columns='periodo', values='entradas', aggfunc='sum', fill_value=0).round(2)
+    ingresos.columns.name = None
+    if ingresos.shape[1] > 1:
+        ant, ult = ingresos.iloc[:, -2], ingresos.iloc[:, -1]
+        ingresos['Variación %'] = ((ult - ant) / ant.where(ant != 0) * 100).round(1)
+    return detalle, ingresos
+
+# ==========================================
+# SALDOS MENSUALES
+# ==========================================
+class MantenedorSaldos(threading.Thread):
+    # Hilo único por proceso que suma los movimientos nuevos a saldos_mensuales, fuera del rerun.
+    # Cada llamada procesa un lote acotado; se repite hasta quedar al día y luego espera.
+    def __init__(self, repo, intervalo=60):
+        super().__init__(daemon=True, name="mantenedor-saldos")
+        self.repo, self.intervalo = repo, intervalo
+        self.ultimo_error = None
+
+    def run(self):
+        while True:
+            try:
+                while self.repo.actualizar_saldos(): pass
+                self.ultimo_error = None
+            except Exception as e: self.ultimo_error = str(e)
+            time.sleep(self.intervalo)
+
+# ==========================================
+# ESCRITURAS POR LOTES
+# ==========================================
+def guardar_movimientos(repo, filas, tam, progreso=None):
+    # Cada fila lleva (id_lote, linea): reenviar un lote ya guardado en parte no duplica stock
+    total = len(filas)
+    for i in range(0, total, tam):
+        chunk = filas[i:i + tam]
+        con_reintentos(lambda: repo.insertar_movimientos(chunk))
+        if progreso: progreso(min(i + tam, total) / total)
+
+def diff_maestro(original, editado):
+    orig = original.set_index('id')[COLUMNAS_MAESTRO]
+    nuevos = editado[editado['id'].isna()][COLUMNAS_MAESTRO]
+    nuevos = nuevos[nuevos['sku'].notna() & (nuevos['sku'].astype(str).str.strip() != "")]
+    existentes = editado[editado['id'].notna()].set_index('id')[COLUMNAS_MAESTRO]
+    existentes.index = existentes.index.astype(orig.index.dtype)
+    eliminados = orig.index.difference(existentes.index).tolist()
+    comunes = existentes.index.intersection(orig.index)
+    a = existentes.loc[comunes].fillna("").astype(str)
+    b = orig.loc[comunes].fillna("").astype(str)
+    modificados = existentes.loc[comunes][(a != b).any(axis=1)].reset_index()
+    return nuevos, modificados, eliminados
+
+def guardar_diff_maestro(repo, nuevos, modificados, eliminados, tam, progreso=None):
+    tareas = [lambda c=c: repo.upsert_productos(c) for c in trozos(registros(modificados), tam)]
+    tareas += [lambda c=c: repo.upsert_productos(c, por_sku=True) for c in trozos(registros(nuevos), tam)]
+    tareas += [lambda c=c: repo.eliminar_productos(c) for c in trozos(eliminados, tam)]
+    for n, tarea in enumerate(tareas, 1):
+        con_reintentos(tarea)
+        if progreso: progreso(n / len(tareas))
+
+# ==========================================
+# IMPORTACIÓN DE CATÁLOGO
+# ==========================================
+IMPORT_CHUNK = 5000  # filas leídas por vez del archivo
+MAPEO_IMPORT = {"Número de artículo": "sku", "Descripción del artículo": "nombre", "Categoria": "categoria"}
+
+def _texto(v):
+    if v is None or (isinstance(v, float) and pd.isna(v)): return None
+    if isinstance(v, float) and v.is_integer(): v = int(v)  # SKUs numéricos de Excel
+    v = str(v).strip()
+    return v or None
+
+def leer_archivo_por_trozos(file, tam=IMPORT_CHUNK):
+    # Devuelve (trozo, avance 0-1) sin cargar el archivo completo en memoria
+    if file.name.endswith('.csv'):
+        total = file.size or 1
+        for df in pd.read_csv(file, chunksize=tam, dtype=str, keep_default_na=False):
+            yield df, min(file.tell() / total, 1.0)
+        return
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total = max((ws.max_row or 1) - 1, 1)
+        filas = ws.iter_rows(values_only=True)
+        cabecera = [str(c).strip() if c is not None else "" for c in next(filas, ())]
+        buf, leidas = [], 0
+        for fila in filas:
+            buf.append(fila[:len(cabecera)])
+            if len(buf) == tam:
+                leidas += len(buf)
+                yield pd.DataFrame(buf, columns=cabecera), min(leidas / total, 1.0)
+                buf = []
+        if buf: yield pd.DataFrame(buf, columns=cabecera), 1.0
+    finally:
+        wb.close()
+
+def normalizar_trozo(df, primera_fila):
+    df = df.rename(columns=MAPEO_IMPORT)
+    faltan = {'sku', 'nombre'} - set(df.columns)
+    if faltan: raise ValueError(f"Faltan columnas: {', '.join(sorted(faltan))}")
+    if 'categoria' not in df.columns: df['categoria'] = None
+    if 'formato_medida' not in df.columns: df['formato_medida'] = "1 unidad"
+    df = df[COLUMNAS_MAESTRO].copy()
+    df.index = range(primera_fila, primera_fila + len(df))  # número de fila en el archivo
+    for c in COLUMNAS_MAESTRO: df[c] = df[c].map(_texto)
+    df['formato_medida'] = df['formato_medida'].fillna("1 unidad")
+    errores = []
+    for col, msg in (('sku', "SKU vacío"), ('nombre', "Nombre vacío")):
+        malos = df[col].isna()
+        errores += [(i, df.at[i, 'sku'], msg) for i in df.index[malos]]
+        df = df[~malos]
+    return df, errores
+
+def importar_catalogo(repo, file, tam, progreso=None):
+    vistos, errores, cargados = set(), [], 0
+    fila = 2  # la fila 1 es la cabecera
+    for trozo, avance in leer_archivo_por_trozos(file):
+        df, errs = normalizar_trozo(trozo, fila)
+        fila += len(trozo)
+        errores += errs
+        dup = df['sku'].duplicated() | df['sku'].isin(vistos)
+        errores += [(i, df.at[i, 'sku'], "SKU duplicado en el archivo") for i in df.index[dup]]
+        df = df[~dup]
+        vistos.update(df['sku'])
+        for parte in trozos(df.index.tolist(), tam):
+            lote = df.loc[parte]
+            try:
+                con_reintentos(lambda: repo.upsert_productos(registros(lote), por_sku=True))
+                cargados += len(lote)
+            except Exception as e:
+                errores += [(i, lote.at[i, 'sku'], f"Error al guardar: {e}") for i in lote.index]
+        if progreso: progreso(avance)
+    return cargados, pd.DataFrame(errores, columns=["Fila", "SKU", "Error"]).sort_values("Fila", kind="stable")
+
+# ==========================================
+# AUDITORÍA MASIVA
+# ==========================================
+MAPEO_CONTEO = {"Número de artículo": "sku", "SKU": "sku", "Conteo": "fisico", "Conteo Físico": "fisico", "Físico": "fisico", "Cantidad": "fisico"}
+
+def leer_conteo(file):
+    # Planilla de conteo físico: sku + cantidad contada (en unidades del formato)
+    partes, errores, fila = [], [], 2
+    for trozo, _ in leer_archivo_por_trozos(file):
+        df = trozo.rename(columns=MAPEO_CONTEO)
+        faltan = {'sku', 'fisico'} - set(df.columns)
+        if faltan: raise ValueError(f"Faltan columnas: {', '.join(sorted(faltan))}")
+        df = df[['sku', 'fisico']].copy()
+        df.index = range(fila, fila + len(df))
+        fila += len(df)
+        df['sku'] = df['sku'].map(_texto)
+        texto = df['fisico'].astype(str).str.strip().str.replace(",", ".", regex=False)
+        df['fisico'] = pd.to_numeric(texto.where(df['fisico'].notna()), errors='coerce')
+        for col, msg in (('sku', "SKU vacío"), ('fisico', "Conteo inválido")):
+            malos = df[col].isna()
+            errores += [(i, df.at[i, 'sku'], msg) for i in df.index[malos]]
+            df = df[~malos]
+        partes.append(df)
+    conteo = pd.concat(partes) if partes else pd.DataFrame(columns=['sku', 'fisico'])
+    # Un SKU contado en varias ubicaciones se suma
+    conteo = conteo.groupby('sku', as_index=False, sort=False)['fisico'].sum()
+    return conteo, pd.DataFrame(errores, columns=["Fila", "SKU", "Error"])
+
+def conciliar_conteo(df_catalogo, stock, conteo):
+    # Un solo merge catálogo x conteo; "sistema" en las mismas unidades que el conteo
+    sis = df_catalogo[['id', 'sku', 'nombre', 'formato_medida']].copy()
+    sis['sku'] = sis['sku'].map(_texto)
+    sis['sistema'] = columna_stock(df_catalogo, stock)
+    m = sis.merge(conteo, on='sku', how='outer', indicator=True)
+    contados = m[m['_merge'] == 'both'].copy()
+    contados['diferencia'] = (contados['fisico'] - contados['sistema']).round(2)
+    sin_contar = m[(m['_merge'] == 'left_only') & (m['sistema'] != 0)]
+    desconocidos = m[m['_merge'] == 'right_only'][['sku', 'fisico']]
+    return {
+        "contados": contados.drop(columns='_merge').astype({'id': int}),
+        "sin_contar": sin_contar[['id', 'sku', 'nombre', 'formato_medida', 'sistema']].astype({'id': int}),
+        "desconocidos": desconocidos,
+    }
@@ -0,0 +1,104 @@
+import functools
+import itertools
+import json
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import pandas as pd
+
+# ==========================================
+# MÉTRICAS DE RENDIMIENTO
+# ==========================================
+# Registro en memoria, por proceso, de cada llamada al repositorio y de cada pantalla.
+# Alimenta la vista de Diagnóstico (solo Admin) y su exportación a CSV.
+
+MAX_EVENTOS = 20000
+MUESTRA_BYTES = 50  # filas serializadas para estimar el tamaño de una respuesta
+
+_eventos = deque(maxlen=MAX_EVENTOS)
+_lock = threading.Lock()
+
+# Sede, usuario y número de rerun en curso. Cada sesión de Streamlit corre en su propio hilo.
+contexto = threading.local()
+_reruns = itertools.count(1)
+
+def fijar_contexto(sede, usuario):
+    contexto.sede, contexto.usuario, contexto.rerun = sede, usuario, next(_reruns)
+
+def capturar_contexto():
+    return {k: getattr(contexto, k, None) for k in ("sede", "usuario", "rerun")}
+
+def aplicar_contexto(valores):
+    for k, v in valores.items(): setattr(contexto, k, v)
+
+def registrar(tipo, nombre, segundos, filas=None, bytes_=None):
+    evento = {
+        "fecha": datetime.now().isoformat(timespec="seconds"), "tipo": tipo, "nombre": nombre,
+        "sede": getattr(contexto, "sede", None), "usuario": getattr(contexto, "usuario", None),
+        "rerun": getattr(contexto, "rerun", None),
+        "ms": round(segundos * 1000, 2), "filas": filas, "bytes": bytes_,
+    }
+    with _lock: _eventos.append(evento)
+
+def limpiar():
+    with _lock: _eventos.clear()
+
+def eventos():
+    with _lock: return pd.DataFrame(list(_eventos), columns=["fecha", "tipo", "nombre", "sede", "usuario", "rerun", "ms", "filas", "bytes"])
+
+def _tamano(res):
+    # Estimación barata: se serializa una muestra y se extrapola
+    if res is None: return 0, 0
+    if isinstance(res, dict): res = list(res.items())
+    if not isinstance(res, list): return None, None
+    if not res: return 0, 2
+    muestra = res[:MUESTRA_BYTES]
+    return len(res), int(len(json.dumps(muestra, default=str)) / len(muestra) * len(res))
+
+class RepositorioInstrumentado:
+    # Envuelve cualquier Repositorio y mide cada método público
+    def __init__(self, repo):
+        self._repo = repo
+
+    def __getattr__(self, nombre):
+        attr = getattr(self._repo, nombre)
+        if nombre.startswith("_") or not callable(attr): return attr
+        @functools.wraps(attr)
+        def medido(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                res = attr(*args, **kwargs)
+            except Exception:
+                registrar("consulta", nombre + " (error)", time.perf_counter() - t0)
+                raise
+            filas, bytes_ = _tamano(res)
+            registrar("consulta", nombre, time.perf_counter() - t0, filas, bytes_)
+            return res
+        return medido
+
+def medir_pantalla(fn):
+    @functools.wraps(fn)
+    def medida(*args, **kwargs):
+        t0 = time.perf_counter()
+        try: return fn(*args, **kwargs)
+        finally: registrar("pantalla", fn.__name__, time.perf_counter() - t0)
+    return medida
+
+def por_rerun(df):
+    # Costo total de backend de cada rerun
+    c = df[(df["tipo"] == "consulta") & df["rerun"].notna()]
+    return c.groupby(["rerun", "sede"], dropna=False).agg(consultas=("ms", "size"), ms=("ms", "sum"), bytes=("bytes", "sum")).reset_index()
+
+def resumen(df, por=("tipo", "nombre")):
+    if df.empty: return df
+    g = df.groupby(list(por), dropna=False)
+    return pd.DataFrame({
+        "llamadas": g.size(),
+        "p50_ms": g["ms"].quantile(0.5).round(1),
+        "p95_ms": g["ms"].quantile(0.95).round(1),
+        "max_ms": g["ms"].max(),
+        "filas_prom": g["filas"].mean().round(0),
+        "kb_prom": (g["bytes"].mean() / 1024).round(1),
+    }).reset_index().sort_values("p95_ms", ascending=False)
@@ -0,0 +1,517 @@
+import functools
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from datetime import datetime, time as hora, timedelta
+
+# ==========================================
+# ACCESO A DATOS
+# ==========================================
+# Todas las pantallas consultan a través de un Repositorio. Hay dos implementaciones con
+# la misma interfaz: Supabase (producción) y SQLite (local, sin red, para pruebas y benchmarks).
+
+SALDOS_LOTE = 50_000  # movimientos que suma actualizar_saldos por llamada
+
+class Repositorio(ABC):
+    # --- locales ---
+    @abstractmethod
+    def listar_locales(self): ...
+
+    # --- productos_maestro ---
+    @abstractmethod
+    def listar_productos(self): ...
+    @abstractmethod
+    def upsert_productos(self, filas, por_sku=False): ...
+    @abstractmethod
+    def eliminar_productos(self, ids): ...
+
+    # --- movimientos_inventario ---
+    # (id, id_producto, cantidad) con id > desde_id, en orden de id
+    @abstractmethod
+    def movimientos_desde(self, local_id, desde_id, limite): ...
+    # {id_producto: cantidad} sumado en el servidor
+    @abstractmethod
+    def stock_agregado(self, local_id): ...
+    # (id, id_local, id_producto, ubicacion, cantidad) de todas las sedes con id > desde_id
+    @abstractmethod
+    def movimientos_todas_desde(self, desde_id, limite): ...
+    # Filas (id_local, id_producto, [ubicacion,] cantidad) sumadas en el servidor, todas las sedes
+    @abstractmethod
+    def stock_por_sede(self, por_ubicacion=False): ...
+    # Filas con (id_lote, linea); las ya guardadas se ignoran
+    @abstractmethod
+    def insertar_movimientos(self, filas): ...
+    # Página con productos_maestro(sku, nombre) embebido, de la más reciente a la más antigua por
+    # (fecha_hora, id); antes_de es el (fecha_hora, id) de la última fila de la página anterior
+    @abstractmethod
+    def historial(self, local_id, filtros, antes_de=None, limite=100): ...
+
+    # --- saldos_mensuales ---
+    # Suma a los saldos hasta `limite` movimientos posteriores al checkpoint; devuelve cuántos
+    # procesó (0: al día)
+    @abstractmethod
+    def actualizar_saldos(self, limite=SALDOS_LOTE): ...
+    # Borra los saldos; el próximo actualizar_saldos los reconstruye desde cero
+    @abstractmethod
+    def reiniciar_saldos(self): ...
+    # {id_producto: cantidad} al cierre de la fecha, incluidos los movimientos aún sin sumar a los saldos
+    @abstractmethod
+    def stock_al(self, local_id, fecha): ...
+    # Filas (id_producto, periodo, entradas, salidas, saldo) de los meses entre desde y hasta
+    @abstractmethod
+    def saldos_periodos(self, local_id, desde, hasta): ...
+
+    # --- compactación ---
+    # {"movimientos", "saldos"} que dejaría compactar con ese corte
+    @abstractmethod
+    def previa_compactacion(self, corte): ...
+    # Reemplaza los movimientos anteriores al corte por filas SALDO_INICIAL y archiva los originales
+    @abstractmethod
+    def compactar_movimientos(self, corte): ...
+    # Id de la última compactación (0 si nunca hubo o si no existe la tabla compactaciones, es
+    # decir, sin sql/compactacion.sql): si cambia, los checkpoints por id ya no valen
+    @abstractmethod
+    def generacion_movimientos(self): ...
+
+    # --- usuarios_sistema ---
+    @abstractmethod
+    def buscar_usuario(self, usuario, clave): ...
+    @abstractmethod
+    def listar_usuarios(self): ...
+    @abstractmethod
+    def upsert_usuario(self, datos): ...
+
+
+# ==========================================
+# SUPABASE
+# ==========================================
+TABLA_INEXISTENTE = ("42P01", "PGRST205")  # códigos de Postgres y PostgREST
+
+def _reconectando(metodo):
+    # Si la conexión se cayó (no un error de la API), se crea un cliente nuevo y se reintenta una vez
+    @functools.wraps(metodo)
+    def envuelto(self, *args, **kwargs):
+        import httpx
+        cliente = self.cliente
+        try:
+            res = metodo(self, *args, **kwargs)
+        except httpx.TransportError:
+            self.reconectar(cliente)
+            res = metodo(self, *args, **kwargs)
+        self._ultimo_ok = time.monotonic()
+        return res
+    return envuelto
+
+class RepositorioSupabase(Repositorio):
+    # Un solo cliente por proceso: su pool HTTP mantiene las conexiones vivas entre reruns y sesiones.
+    # No se usa Supabase Auth, así que el cliente no guarda estado de ningún usuario.
+    def __init__(self, fabrica, intervalo_salud=60):
+        self._fabrica = fabrica
+        self._lock = threading.Lock()
+        self.intervalo_salud = intervalo_salud
+        self.cliente = fabrica()
+        self._ultimo_ok = time.monotonic()
+
+    def reconectar(self, fallido=None):
+        with self._lock:
+            # Si otro hilo ya lo reemplazó, no se crea un segundo cliente
+            if fallido is None or self.cliente is fallido:
+                self.cliente = self._fabrica()
+
+    def sano(self):
+        # Solo se consulta al servidor si la conexión estuvo inactiva más de intervalo_salud
+        if time.monotonic() - self._ultimo_ok < self.intervalo_salud: return True
+        try:
+            self.cliente.table("locales").select("id").limit(1).execute()
+            self._ultimo_ok = time.monotonic()
+            return True
+        except Exception:
+            return False
+
+    def _paginado(self, consulta, pagina=1000):
+        # PostgREST corta las respuestas en max-rows (1000 por defecto); se pide por rangos.
+        # Solo para tablas: sobre una función agregada cada página repetiría el cálculo completo
+        filas, inicio = [], 0
+        while True:
+            res = consulta().range(inicio, inicio + pagina - 1).execute().data or []
+            filas += res
+            if len(res) < pagina: return filas
+            inicio += pagina
+
+    @_reconectando
+    def listar_locales(self):
+        return self.cliente.table("locales").select("id, nombre").execute().data or []
+
+    @_reconectando
+    def listar_productos(self):
+        return self._paginado(lambda: self.cliente.table("productos_maestro").select("*").order("id"))
+
+    @_reconectando
+    def upsert_productos(self, filas, por_sku=False):
+        if por_sku: self.cliente.table("productos_maestro").upsert(filas, on_conflict="sku").execute()
+        else: self.cliente.table("productos_maestro").upsert(filas).execute()
+
+    @_reconectando
+    def eliminar_productos(self, ids):
+        self.cliente.table("productos_maestro").delete().in_("id", ids).execute()
+
+    @_reconectando
+    def movimientos_desde(self, local_id, desde_id, limite):
+        return self.cliente.table("movimientos_inventario").select("id, id_producto, cantidad").eq("id_local", local_id).gt("id", desde_id).order("id").limit(limite).execute().data or []
+
+    @_reconectando
+    def stock_agregado(self, local_id):
+        # Un arreglo json en una sola respuesta: max-rows no lo corta
+        res = self.cliente.rpc("stock_por_local", {"p_id_local": local_id}).execute().data or []
+        return {p: c for p, c in res}
+
+    @_reconectando
+    def movimientos_todas_desde(self, desde_id, limite):
+        return self.cliente.table("movimientos_inventario").select("id, id_local, id_producto, ubicacion, cantidad").gt("id", desde_id).order("id").limit(limite).execute().data or []
+
+    @_reconectando
+    def stock_por_sede(self, por_ubicacion=False):
+        res = self.cliente.rpc("stock_por_sede", {"p_por_ubicacion": por_ubicacion}).execute().data or []
+        return [{"id_local": l, "id_producto": p, "ubicacion": u, "cantidad": c} for l, p, u, c in res]
+
+    @_reconectando
+    def insertar_movimientos(self, filas):
+        self.cliente.table("movimientos_inventario").upsert(filas, on_conflict="id_lote,linea", ignore_duplicates=True).execute()
+
+    @_reconectando
+    def historial(self, local_id, filtros, antes_de=None, limite=100):
+        q = self.cliente.table("movimientos_inventario").select("id, fecha_hora, tipo_movimiento, cantidad, ubicacion, productos_maestro(sku, nombre)").eq("id_local", local_id)
+        if filtros.get("desde"): q = q.gte("fecha_hora", filtros["desde"].isoformat())
+        if filtros.get("hasta"): q = q.lt("fecha_hora", (filtros["hasta"] + timedelta(days=1)).isoformat())
+        if filtros.get("id_producto"): q = q.eq("id_producto", filtros["id_producto"])
+        if filtros.get("tipos"): q = q.in_("tipo_movimiento", filtros["tipos"])
+        if filtros.get("ubicaciones"): q = q.in_("ubicacion", filtros["ubicaciones"])
+        if antes_de is not None:
+            # (fecha_hora, id) < antes_de; las filas SALDO_INICIAL quedan en su fecha, no arriba
+            f, i = antes_de
+            q = q.or_(f'fecha_hora.lt."{f}",and(fecha_hora.eq."{f}",id.lt.{i})')
+        return q.order("fecha_hora", desc=True).order("id", desc=True).limit(limite).execute().data or []
+
+    @_reconectando
+    def actualizar_saldos(self, limite=SALDOS_LOTE):
+        return self.cliente.rpc("actualizar_saldos", {"p_limite": limite}).execute().data or 0
+
+    @_reconectando
+    def reiniciar_saldos(self):
+        self.cliente.rpc("reiniciar_saldos", {}).execute()
+
+    @_reconectando
+    def stock_al(self, local_id, fecha):
+        res = self.cliente.rpc("stock_al", {"p_id_local": local_id, "p_fecha": fecha.isoformat()}).execute().data or []
+        return {p: c for p, c in res}
+
+    @_reconectando
+    def saldos_periodos(self, local_id, desde, hasta):
+        return self._paginado(lambda: self.cliente.table("saldos_mensuales").select("id_producto, periodo, entradas, salidas, saldo")
+                              .eq("id_local", local_id).gte("periodo", desde.isoformat()).lte("periodo", hasta.isoformat())
+                              .order("periodo").order("id_producto"))
+
+    @_reconectando
+    def previa_compactacion(self, corte):
+        return self.cliente.rpc("previa_compactacion", {"p_corte": corte.isoformat()}).execute().data[0]
+
+    @_reconectando
+    def compactar_movimientos(self, corte):
+        return self.cliente.rpc("compactar_movimientos", {"p_corte": corte.isoformat()}).execute().data[0]
+
+    @_reconectando
+    def generacion_movimientos(self):
+        from postgrest.exceptions import APIError
+        try:
+            res = self.cliente.table("compactaciones").select("id").order("id", desc=True).limit(1).execute().data
+        except APIError as e:
+            # Tabla inexistente: la compactación no está instalada, así que nunca hubo una
+            if e.code in TABLA_INEXISTENTE: return 0
+            raise
+        return res[0]['id'] if res else 0
+
+    @_reconectando
+    def buscar_usuario(self, usuario, clave):
+        res = self.cliente.table("usuarios_sistema").select("*").eq("usuario", usuario).eq("clave", clave).execute().data
+        return res[0] if res else None
+
+    @_reconectando
+    def listar_usuarios(self):
+        return self._paginado(lambda: self.cliente.table("usuarios_sistema").select("*").order("id"))
+
+    @_reconectando
+    def upsert_usuario(self, datos):
+        self.cliente.table("usuarios_sistema").upsert(datos, on_conflict="usuario").execute()
+
+
+# ==========================================
+# SQLITE
+# ==========================================
+ESQUEMA_SQLITE = """
+create table if not exists locales (
+    id integer primary key,
+    nombre text not null
+);
+create table if not exists productos_maestro (
+    id integer primary key,
+    sku text not null unique,
+    nombre text,
+    categoria text,
+    formato_medida text
+);
+create table if not exists movimientos_inventario (
+    id integer primary key autoincrement,
+    fecha_hora text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    id_local integer not null references locales(id),
+    id_producto integer not null references productos_maestro(id),
+    cantidad real not null,
+    tipo_movimiento text,
+    ubicacion text,
+    id_lote text,
+    linea integer
+);
+create table if not exists usuarios_sistema (
+    id integer primary key,
+    nombre_apellido text,
+    id_local integer references locales(id),
+    usuario text not null unique,
+    clave text,
+    rol text
+);
+create table if not exists saldos_mensuales (
+    id_local integer not null,
+    id_producto integer not null,
+    periodo text not null,
+    entradas real not null default 0,
+    salidas real not null default 0,
+    saldo real not null default 0,
+    primary key (id_local, id_producto, periodo)
+);
+create table if not exists saldos_control (
+    id integer primary key check (id = 1),
+    ultimo_id integer not null default 0
+);
+insert or ignore into saldos_control (id, ultimo_id) values (1, 0);
+create table if not exists movimientos_archivo (
+    id integer primary key,
+    fecha_hora text not null,
+    id_local integer not null,
+    id_producto integer not null,
+    cantidad real not null,
+    tipo_movimiento text,
+    ubicacion text,
+    id_lote text,
+    linea integer,
+    archivado text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now'))
+);
+create index if not exists idx_archivo_local_fecha on movimientos_archivo (id_local, fecha_hora);
+create table if not exists compactaciones (
+    id integer primary key autoincrement,
+    corte text not null,
+    id_lote text not null,
+    fecha text not null default (strftime('%Y-%m-%dT%H:%M:%f', 'now')),
+    movimientos integer not null,
+    saldos integer not null
+);
+create unique index if not exists uq_movimientos_lote_linea on movimientos_inventario (id_lote, linea);
+create index if not exists idx_movimientos_local_id on movimientos_inventario (id_local, id);
+create index if not exists idx_movimientos_local_fecha_id on movimientos_inventario (id_local, fecha_hora, id);
+create index if not exists idx_movimientos_local_producto on movimientos_inventario (id_local, id_producto, id);
+"""
+
+SALDO_INICIAL = "SALDO_INICIAL"  # tipo_movimiento de las filas que resumen movimientos archivados
+
+COLUMNAS_PRODUCTO = ("sku", "nombre", "categoria", "formato_medida")
+COLUMNAS_MOVIMIENTO = ("id_local", "id_producto", "cantidad", "tipo_movimiento", "ubicacion", "id_lote", "linea")
+COLUMNAS_USUARIO = ("nombre_apellido", "id_local", "usuario", "clave", "rol")
+
+
+class RepositorioSQLite(Repositorio):
+    def __init__(self, ruta=":memory:"):
+        # Una conexión compartida entre los hilos de Streamlit, serializada con un lock
+        self.con = sqlite3.connect(ruta, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
+        self.lock = threading.Lock()
+        with self.lock:
+            self.con.execute("pragma journal_mode=wal")
+            # Como en Postgres: las references se validan (SQLite las ignora si no se activa)
+            self.con.execute("pragma foreign_keys = on")
+            self.con.executescript(ESQUEMA_SQLITE)
+
+    def _consultar(self, sql, params=()):
+        with self.lock:
+            return [dict(r) for r in self.con.execute(sql, params).fetchall()]
+
+    def _escribir(self, sql, filas):
+        with self.lock, self.con:
+            self.con.executemany(sql, filas)
+
+    def listar_locales(self):
+        return self._consultar("select id, nombre from locales")
+
+    def listar_productos(self):
+        return self._consultar("select * from productos_maestro")
+
+    def upsert_productos(self, filas, por_sku=False):
+        if not filas: return
+        cols = COLUMNAS_PRODUCTO if por_sku else ("id",) + COLUMNAS_PRODUCTO
+        clave = "sku" if por_sku else "id"
+        sets = ", ".join(f"{c} = excluded.{c}" for c in COLUMNAS_PRODUCTO if c != clave)
+        sql = f"insert into productos_maestro ({', '.join(cols)}) values ({', '.join('?' * len(cols))}) on conflict ({clave}) do update set {sets}"
+        self._escribir(sql, [tuple(f.get(c) for c in cols) for f in filas])
+
+    def eliminar_productos(self, ids):
+        self._escribir("delete from productos_maestro where id = ?", [(i,) for i in ids])
+
+    def movimientos_desde(self, local_id, desde_id, limite):
+        return self._consultar("select id, id_producto, cantidad from movimientos_inventario where id_local = ? and id > ? order by id limit ?", (local_id, desde_id, limite))
+
+    def stock_agregado(self, local_id):
+        res = self._consultar("select id_producto, sum(cantidad) as cantidad from movimientos_inventario where id_local = ? group by id_producto", (local_id,))
+        return {r['id_producto']: r['cantidad'] for r in res}
+
+    def movimientos_todas_desde(self, desde_id, limite):
+        return self._consultar("select id, id_local, id_producto, ubicacion, cantidad from movimientos_inventario where id > ? order by id limit ?", (desde_id, limite))
+
+    def stock_por_sede(self, por_ubicacion=False):
+        ubi = "ubicacion" if por_ubicacion else "null"
+        return self._consultar(f"select id_local, id_producto, {ubi} as ubicacion, sum(cantidad) as cantidad from movimientos_inventario group by id_local, id_producto, {ubi}")
+
+    def insertar_movimientos(self, filas):
+        cols = COLUMNAS_MOVIMIENTO
+        sql = f"insert into movimientos_inventario ({', '.join(cols)}) values ({', '.join('?' * len(cols))}) on conflict (id_lote, linea) do nothing"
+        self._escribir(sql, [tuple(f.get(c) for c in cols) for f in filas])
+
+    def historial(self, local_id, filtros, antes_de=None, limite=100):
+        where, params = ["m.id_local = ?"], [local_id]
+        if filtros.get("desde"):
+            where.append("m.fecha_hora >= ?"); params.append(filtros["desde"].isoformat())
+        if filtros.get("hasta"):
+            where.append("m.fecha_hora < ?"); params.append((filtros["hasta"] + timedelta(days=1)).isoformat())
+        if filtros.get("id_producto"):
+            where.append("m.id_producto = ?"); params.append(filtros["id_producto"])
+        for col, clave in (("tipo_movimiento", "tipos"), ("ubicacion", "ubicaciones")):
+            if filtros.get(clave):
+                where.append(f"m.{col} in ({', '.join('?' * len(filtros[clave]))})"); params += list(filtros[clave])
+        if antes_de is not None:
+            where.append("(m.fecha_hora, m.id) < (?, ?)"); params += list(antes_de)
+        res = self._consultar(
+            "select m.id, m.fecha_hora, m.tipo_movimiento, m.cantidad, m.ubicacion, p.sku, p.nombre "
+            "from movimientos_inventario m left join productos_maestro p on p.id = m.id_producto "
+            f"where {' and '.join(where)} order by m.fecha_hora desc, m.id desc limit ?", params + [limite])
+        # Misma forma que el embed de PostgREST
+        for r in res: r['productos_maestro'] = {"sku": r.pop('sku'), "nombre": r.pop('nombre')}
+        return res
+
+    def actualizar_saldos(self, limite=SALDOS_LOTE):
+        # Misma lógica que actualizar_saldos() en sql/saldos_mensuales.sql. Las escrituras van de a
+        # una (self.lock), así que los ids se confirman en orden y no hace falta el retraso.
+        with self.lock, self.con:
+            c = self.con
+            desde = c.execute("select ultimo_id from saldos_control where id = 1").fetchone()[0]
+            hasta = c.execute(
+                "select max(id) from (select id from (select id from movimientos_inventario where id > ?1 "
+                "union all select id from movimientos_archivo where id > ?1) order by id limit ?2)", (desde, limite)).fetchone()[0]
+            if hasta is None: return 0
+            rango = ("select id_local, id_producto, fecha_hora, cantidad, tipo_movimiento from movimientos_inventario where id > ?1 and id <= ?2 "
+                     "union all select id_local, id_producto, fecha_hora, cantidad, tipo_movimiento from movimientos_archivo where id > ?1 and id <= ?2")
+            n = c.execute(f"select count(*) from ({rango})", (desde, hasta)).fetchone()[0]
+            c.execute("drop table if exists temp._delta")
+            c.execute(
+                "create temp table _delta as select id_local, id_producto, substr(fecha_hora, 1, 7) || '-01' as periodo, "
+                f"sum(max(cantidad, 0)) as entradas, sum(min(cantidad, 0)) as salidas from ({rango}) "
+                f"where tipo_movimiento is not '{SALDO_INICIAL}' group by 1, 2, 3", (desde, hasta))
+            c.execute(
+                "insert or ignore into saldos_mensuales (id_local, id_producto, periodo, saldo) "
+                "select d.id_local, d.id_producto, d.periodo, coalesce((select s.saldo from saldos_mensuales s "
+                "where s.id_local = d.id_local and s.id_producto = d.id_producto and s.periodo < d.periodo order by s.periodo desc limit 1), 0) "
+                "from _delta d")
+            c.execute(
+                "update saldos_mensuales as s set entradas = s.entradas + d.entradas, salidas = s.salidas + d.salidas "
+                "from _delta d where s.id_local = d.id_local and s.id_producto = d.id_producto and s.periodo = d.periodo")
+            c.execute(
+                "update saldos_mensuales as s set saldo = s.saldo + x.delta from ("
+                "select s2.id_local, s2.id_producto, s2.periodo, sum(d.entradas + d.salidas) as delta from saldos_mensuales s2 "
+                "join _delta d on d.id_local = s2.id_local and d.id_producto = s2.id_producto and d.periodo <= s2.periodo group by 1, 2, 3) x "
+                "where s.id_local = x.id_local and s.id_producto = x.id_producto and s.periodo = x.periodo")
+            c.execute("drop table temp._delta")
+            c.execute("update saldos_control set ultimo_id = ? where id = 1", (hasta,))
+            return n
+
+    def reiniciar_saldos(self):
+        with self.lock, self.con:
+            self.con.execute("delete from saldos_mensuales")
+            self.con.execute("update saldos_control set ultimo_id = 0 where id = 1")
+
+    def stock_al(self, local_id, fecha):
+        mes = fecha.replace(day=1).isoformat()
+        res = self._consultar(
+            "select id_producto, sum(cantidad) as cantidad from ("
+            "select s.id_producto, s.saldo as cantidad from saldos_mensuales s where s.id_local = ?1 and s.periodo = "
+            "(select max(s2.periodo) from saldos_mensuales s2 where s2.id_local = s.id_local and s2.id_producto = s.id_producto and s2.periodo < ?2) "
+            "union all select id_producto, cantidad from movimientos_inventario where id_local = ?1 and fecha_hora >= ?2 and fecha_hora < ?3 "
+            f"and tipo_movimiento is not '{SALDO_INICIAL}' "
+            "union all select id_producto, cantidad from movimientos_archivo where id_local = ?1 and fecha_hora >= ?2 and fecha_hora < ?3 "
+            f"and tipo_movimiento is not '{SALDO_INICIAL}' "
+            # Anteriores al mes que todavía no se sumaron a los saldos
+            "union all select id_producto, cantidad from movimientos_inventario where id > (select ultimo_id from saldos_control where id = 1) and id_local = ?1 and fecha_hora < ?2 "
+            f"and tipo_movimiento is not '{SALDO_INICIAL}' "
+            "union all select id_producto, cantidad from movimientos_archivo where id > (select ultimo_id from saldos_control where id = 1) and id_local = ?1 and fecha_hora < ?2 "
+            f"and tipo_movimiento is not '{SALDO_INICIAL}'"
+            ") group by id_producto", (local_id, mes, (fecha + timedelta(days=1)).isoformat()))
+        return {r['id_producto']: r['cantidad'] for r in res}
+
+    def saldos_periodos(self, local_id, desde, hasta):
+        return self._consultar(
+            "select id_producto, periodo, entradas, salidas, saldo from saldos_mensuales "
+            "where id_local = ? and periodo between ? and ? order by periodo, id_producto", (local_id, desde.isoformat(), hasta.isoformat()))
+
+    def previa_compactacion(self, corte):
+        return self._consultar(
+            "select count(*) as movimientos, count(distinct id_local || '|' || id_producto || '|' || coalesce(ubicacion, '')) as saldos "
+            "from movimientos_inventario where fecha_hora < ?", (corte.isoformat(),))[0]
+
+    def compactar_movimientos(self, corte):
+        # Misma lógica que compactar_movimientos() en sql/compactacion.sql, en una sola transacción
+        if corte > datetime.now().date(): raise ValueError("La fecha de corte no puede ser futura")
+        por_grupo = "select id_local, id_producto, ubicacion, sum(cantidad) as cantidad from movimientos_inventario group by 1, 2, 3"
+        lote, c = str(uuid.uuid4()), self.con
+        with self.lock, self.con:
+            antes = {(r[0], r[1], r[2]): r[3] for r in c.execute(por_grupo)}
+            saldos = c.execute(
+                "insert into movimientos_inventario (fecha_hora, id_local, id_producto, cantidad, tipo_movimiento, ubicacion, id_lote, linea) "
+                f"select ?, id_local, id_producto, sum(cantidad), '{SALDO_INICIAL}', ubicacion, ?, row_number() over (order by id_local, id_producto, ubicacion) - 1 "
+                "from movimientos_inventario where fecha_hora < ? group by id_local, id_producto, ubicacion having sum(cantidad) <> 0",
+                ((datetime.combine(corte, hora()) - timedelta(seconds=1)).isoformat(), lote, corte.isoformat())).rowcount
+            c.execute(
+                "insert into movimientos_archivo (id, fecha_hora, id_local, id_producto, cantidad, tipo_movimiento, ubicacion, id_lote, linea) "
+                "select id, fecha_hora, id_local, id_producto, cantidad, tipo_movimiento, ubicacion, id_lote, linea "
+                "from movimientos_inventario where fecha_hora < ? and id_lote is not ?", (corte.isoformat(), lote))
+            movimientos = c.execute("delete from movimientos_inventario where fecha_hora < ? and id_lote is not ?", (corte.isoformat(), lote)).rowcount
+            despues = {(r[0], r[1], r[2]): r[3] for r in c.execute(por_grupo)}
+            dif = [k for k in antes.keys() | despues.keys() if abs(antes.get(k, 0) - despues.get(k, 0)) > 1e-6]
+            # La excepción deshace la transacción completa
+            if dif: raise ValueError(f"El stock no coincide después de compactar ({len(dif)} combinaciones); no se modificó nada")
+            if movimientos:
+                c.execute("insert into compactaciones (corte, id_lote, movimientos, saldos) values (?, ?, ?, ?)", (corte.isoformat(), lote, movimientos, saldos))
+        return {"movimientos": movimientos, "saldos": saldos}
+
+    def generacion_movimientos(self):
+        try: return self._consultar("select coalesce(max(id), 0) as id from compactaciones")[0]['id']
+        except sqlite3.OperationalError as e:
+            if "no such table" in str(e): return 0
+            raise
+
+    def buscar_usuario(self, usuario, clave):
+        res = self._consultar("select * from usuarios_sistema where usuario = ? and clave = ?", (usuario, clave))
+        return res[0] if res else None
+
+    def listar_usuarios(self):
+        return self._consultar("select * from usuarios_sistema")
+
+    def upsert_usuario(self, datos):
+        cols = COLUMNAS_USUARIO
+        sets = ", ".join(f"{c} = excluded.{c}" for c in cols if c != "usuario")
+        self._escribir(f"insert into usuarios_sistema ({', '.join(cols)}) values ({', '.join('?' * len(cols))}) on conflict (usuario) do update set {sets}", [tuple(datos.get(c) for c in cols)])
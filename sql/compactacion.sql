@@ -0,0 +1,84 @@
+-- Compactación del libro de movimientos. Requiere sql/saldos_mensuales.sql (movimientos_archivo).
+-- Por sede, producto y ubicación, los movimientos anteriores a p_corte se reemplazan por una fila
+-- SALDO_INICIAL con su suma, y los originales pasan a movimientos_archivo. Si el stock de alguna
+-- combinación cambia, se aborta y no se modifica nada.
+--
+-- Para programarla con pg_cron (el día 1 de cada mes, deja 12 meses vigentes):
+--   select cron.schedule('compactar-movimientos', '0 4 1 * *',
+--       $$select * from compactar_movimientos((date_trunc('month', now()) - interval '12 months')::date)$$);
+
+-- Cada compactación queda registrada. Los libros incrementales de la app guardan el id de la
+-- última que vieron: si cambia, sus checkpoints ya no valen (los movimientos sumados se archivaron
+-- y las filas SALDO_INICIAL nuevas los repiten) y se reconstruyen desde cero.
+create table if not exists compactaciones (
+    id bigint generated always as identity primary key,
+    corte date not null,
+    id_lote uuid not null,
+    fecha timestamptz not null default now(),
+    movimientos bigint not null,
+    saldos bigint not null
+);
+
+create or replace function compactar_movimientos(p_corte date)
+returns table (movimientos bigint, saldos bigint)
+language plpgsql
+as $$
+declare
+    v_lote uuid := gen_random_uuid();
+    v_mov bigint;
+    v_sal bigint;
+    v_dif bigint;
+begin
+    if p_corte > current_date then raise exception 'La fecha de corte no puede ser futura'; end if;
+    -- Sin inserciones concurrentes mientras se compacta; los carritos reintentan solos
+    lock table movimientos_inventario in share row exclusive mode;
+
+    create temp table _antes on commit drop as
+        select id_local, id_producto, ubicacion, sum(cantidad) as cantidad
+        from movimientos_inventario group by 1, 2, 3;
+
+    insert into movimientos_inventario (fecha_hora, id_local, id_producto, cantidad, tipo_movimiento, ubicacion, id_lote, linea)
+    select p_corte - interval '1 second', id_local, id_producto, sum(cantidad), 'SALDO_INICIAL', ubicacion, v_lote,
+           (row_number() over (order by id_local, id_producto, ubicacion) - 1)::int
+    from movimientos_inventario
+    where fecha_hora < p_corte
+    group by id_local, id_producto, ubicacion
+    having sum(cantidad) <> 0;
+    get diagnostics v_sal = row_count;
+
+    with movidos as (
+        delete from movimientos_inventario
+        where fecha_hora < p_corte and id_lote is distinct from v_lote
+        returning *
+    )
+    insert into movimientos_archivo select * from movidos;
+    get diagnostics v_mov = row_count;
+
+    select count(*) into v_dif
+    from _antes a
+    full join (select id_local, id_producto, ubicacion, sum(cantidad) as cantidad
+               from movimientos_inventario group by 1, 2, 3) d
+      on d.id_local = a.id_local and d.id_producto = a.id_producto and d.ubicacion is not distinct from a.ubicacion
+    where abs(coalesce(a.cantidad, 0) - coalesce(d.cantidad, 0)) > 1e-6;
+    if v_dif > 0 then
+        raise exception 'El stock no coincide después de compactar (% combinaciones); no se modificó nada', v_dif;
+    end if;
+
+    if v_mov > 0 then
+        insert into compactaciones (corte, id_lote, movimientos, saldos) values (p_corte, v_lote, v_mov, v_sal);
+    end if;
+
+    return query select v_mov, v_sal;
+end;
+$$;
+
+-- Vista previa: cuántos movimientos se archivarían y en cuántas filas de saldo quedarían
+create or replace function previa_compactacion(p_corte date)
+returns table (movimientos bigint, saldos bigint)
+language sql
+stable
+as $$
+    select count(*), count(distinct (id_local, id_producto, ubicacion))
+    from movimientos_inventario
+    where fecha_hora < p_corte;
+$$;
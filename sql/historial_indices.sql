@@ -0,0 +1,9 @@
+-- Índices para el historial filtrado y paginado por (fecha_hora, id) (Reportes).
+
+drop index if exists idx_movimientos_local_fecha;
+
+create index if not exists idx_movimientos_local_fecha_id
+    on movimientos_inventario (id_local, fecha_hora, id);
+
+create index if not exists idx_movimientos_local_producto
+    on movimientos_inventario (id_local, id_producto, id);
@@ -0,0 +1,9 @@
+-- Idempotencia del guardado de carritos: cada línea se identifica por (id_lote, linea).
+-- Un reintento del mismo lote no vuelve a insertar las líneas ya guardadas.
+
+alter table movimientos_inventario
+    add column if not exists id_lote uuid,
+    add column if not exists linea integer;
+
+create unique index if not exists uq_movimientos_lote_linea
+    on movimientos_inventario (id_lote, linea);
@@ -0,0 +1,158 @@
+-- Saldos mensuales por sede y producto: entradas, salidas y saldo al cierre de cada mes.
+-- Se mantienen en forma incremental con actualizar_saldos() (solo suma los movimientos
+-- posteriores al checkpoint), así el stock a una fecha lee un saldo y los movimientos del mes.
+-- Los ids de una secuencia no se confirman en orden: una transacción lenta puede guardar un id
+-- menor al de otra ya confirmada. Por eso solo se suman movimientos más viejos que p_retraso
+-- (mayor al doble de la transacción más larga) y, en cada llamada, a lo sumo p_limite; se llama
+-- hasta que devuelve 0. Lo que todavía no se sumó lo agrega stock_al() desde los movimientos.
+--
+-- La app lo llama desde un hilo aparte cada SALDOS_INTERVALO segundos. Con pg_cron se puede
+-- dejar en la base (y poner SALDOS_INTERVALO = 0 en la app); cada corrida es su propia
+-- transacción y suma un lote:
+--   select cron.schedule('actualizar-saldos', '* * * * *', $$select actualizar_saldos()$$);
+-- Se calculan sobre los movimientos originales: los vigentes más los archivados por
+-- compactar_movimientos() (sql/compactacion.sql), sin las filas SALDO_INICIAL que los resumen.
+
+create table if not exists movimientos_archivo (like movimientos_inventario including defaults);
+alter table movimientos_archivo add column if not exists archivado timestamptz not null default now();
+create unique index if not exists uq_archivo_id on movimientos_archivo (id);
+create index if not exists idx_archivo_local_fecha on movimientos_archivo (id_local, fecha_hora);
+
+create table if not exists saldos_mensuales (
+    id_local bigint not null,
+    id_producto bigint not null,
+    periodo date not null,
+    entradas numeric not null default 0,
+    salidas numeric not null default 0,
+    saldo numeric not null default 0,
+    primary key (id_local, id_producto, periodo)
+);
+
+create table if not exists saldos_control (
+    id int primary key default 1 check (id = 1),
+    ultimo_id bigint not null default 0
+);
+insert into saldos_control (id, ultimo_id) values (1, 0) on conflict do nothing;
+
+drop function if exists actualizar_saldos();
+
+create or replace function actualizar_saldos(p_limite int default 50000, p_retraso interval default '5 minutes')
+returns bigint
+language plpgsql
+as $$
+declare
+    v_desde bigint;
+    v_hasta bigint;
+    v_n bigint;
+begin
+    perform pg_advisory_xact_lock(hashtext('saldos_mensuales'));
+    select ultimo_id into v_desde from saldos_control where id = 1;
+    -- Marca segura: un id con fecha_hora (inicio de su transacción) anterior a p_retraso ya no
+    -- tiene ids menores pendientes. Los archivados y los SALDO_INICIAL se confirmaron con la
+    -- tabla bloqueada, así que tampoco dejan huecos detrás.
+    select max(id) into v_hasta from (
+        select id from (
+            select id from movimientos_inventario
+            where id > v_desde and (fecha_hora < now() - p_retraso or tipo_movimiento = 'SALDO_INICIAL')
+            union all
+            select id from movimientos_archivo where id > v_desde
+        ) c
+        order by id
+        limit p_limite
+    ) t;
+    if v_hasta is null then return 0; end if;
+
+    create temp table _rango on commit drop as
+        select id_local, id_producto, fecha_hora, cantidad, tipo_movimiento from movimientos_inventario
+        where id > v_desde and id <= v_hasta
+        union all
+        select id_local, id_producto, fecha_hora, cantidad, tipo_movimiento from movimientos_archivo
+        where id > v_desde and id <= v_hasta;
+    select count(*) into v_n from _rango;
+
+    create temp table _delta on commit drop as
+        select id_local, id_producto, date_trunc('month', fecha_hora)::date as periodo,
+               sum(greatest(cantidad, 0)) as entradas, sum(least(cantidad, 0)) as salidas
+        from _rango
+        where tipo_movimiento is distinct from 'SALDO_INICIAL'
+        group by 1, 2, 3;
+
+    -- Mes nuevo: parte del saldo del último mes anterior
+    insert into saldos_mensuales (id_local, id_producto, periodo, saldo)
+    select d.id_local, d.id_producto, d.periodo,
+           coalesce((select s.saldo from saldos_mensuales s
+                     where s.id_local = d.id_local and s.id_producto = d.id_producto and s.periodo < d.periodo
+                     order by s.periodo desc limit 1), 0)
+    from _delta d
+    on conflict do nothing;
+
+    update saldos_mensuales s
+    set entradas = s.entradas + d.entradas, salidas = s.salidas + d.salidas
+    from _delta d
+    where s.id_local = d.id_local and s.id_producto = d.id_producto and s.periodo = d.periodo;
+
+    -- Un movimiento mueve el saldo de su mes y de todos los meses siguientes
+    update saldos_mensuales s
+    set saldo = s.saldo + x.delta
+    from (
+        select s2.id_local, s2.id_producto, s2.periodo, sum(d.entradas + d.salidas) as delta
+        from saldos_mensuales s2
+        join _delta d on d.id_local = s2.id_local and d.id_producto = s2.id_producto and d.periodo <= s2.periodo
+        group by 1, 2, 3
+    ) x
+    where s.id_local = x.id_local and s.id_producto = x.id_producto and s.periodo = x.periodo;
+
+    update saldos_control set ultimo_id = v_hasta where id = 1;
+    return v_n;
+end;
+$$;
+
+create or replace function reiniciar_saldos()
+returns void
+language sql
+as $$
+    truncate saldos_mensuales;
+    update saldos_control set ultimo_id = 0 where id = 1;
+$$;
+
+-- Stock al cierre de p_fecha: saldo del último mes cerrado + movimientos anteriores al mes que
+-- aún no se sumaron a los saldos + movimientos del mes hasta esa fecha.
+-- Devuelve un arreglo json [[id_producto, cantidad], ...] en una sola respuesta.
+drop function if exists stock_al(bigint, date);
+
+create or replace function stock_al(p_id_local bigint, p_fecha date)
+returns jsonb
+language sql
+stable
+as $$
+    with control as (
+        select ultimo_id from saldos_control where id = 1
+    ), base as (
+        select distinct on (s.id_producto) s.id_producto, s.saldo
+        from saldos_mensuales s
+        where s.id_local = p_id_local and s.periodo < date_trunc('month', p_fecha)::date
+        order by s.id_producto, s.periodo desc
+    ), movs as (
+        -- Los del mes, por fecha, y los anteriores al mes que quedan después del checkpoint, por id
+        select id_producto, cantidad, tipo_movimiento from movimientos_inventario
+        where id_local = p_id_local and fecha_hora >= date_trunc('month', p_fecha) and fecha_hora < p_fecha + 1
+        union all
+        select id_producto, cantidad, tipo_movimiento from movimientos_archivo
+        where id_local = p_id_local and fecha_hora >= date_trunc('month', p_fecha) and fecha_hora < p_fecha + 1
+        union all
+        select id_producto, cantidad, tipo_movimiento from movimientos_inventario
+        where id > (select ultimo_id from control) and id_local = p_id_local and fecha_hora < date_trunc('month', p_fecha)
+        union all
+        select id_producto, cantidad, tipo_movimiento from movimientos_archivo
+        where id > (select ultimo_id from control) and id_local = p_id_local and fecha_hora < date_trunc('month', p_fecha)
+    ), total as (
+        select id_producto, sum(cantidad) as cantidad
+        from (
+            select id_producto, saldo as cantidad from base
+            union all
+            select id_producto, cantidad from movs where tipo_movimiento is distinct from 'SALDO_INICIAL'
+        ) x
+        group by id_producto
+    )
+    select coalesce(jsonb_agg(jsonb_build_array(id_producto, cantidad)), '[]'::jsonb) from total;
+$$;
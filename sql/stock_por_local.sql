@@ -0,0 +1,23 @@
+-- Agregado de stock en el servidor: una fila por producto en lugar de una por movimiento.
+-- Se activa con USAR_RPC_STOCK = true en .streamlit/secrets.toml.
+-- Devuelve un solo arreglo json [[id_producto, cantidad], ...]: PostgREST no aplica max-rows
+-- a un valor escalar, así que el agregado llega completo en una respuesta y se calcula una vez.
+
+create index if not exists idx_movimientos_local_id
+    on movimientos_inventario (id_local, id);
+
+drop function if exists stock_por_local(bigint);
+
+create or replace function stock_por_local(p_id_local bigint)
+returns jsonb
+language sql
+stable
+as $$
+    select coalesce(jsonb_agg(jsonb_build_array(t.id_producto, t.cantidad)), '[]'::jsonb)
+    from (
+        select m.id_producto, sum(m.cantidad) as cantidad
+        from movimientos_inventario m
+        where m.id_local = p_id_local
+        group by m.id_producto
+    ) t;
+$$;
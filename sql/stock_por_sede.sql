@@ -0,0 +1,21 @@
+-- Stock de todas las sedes en una sola consulta, para la matriz de Admin.
+-- Con p_por_ubicacion = true se separa además por ubicación.
+-- Devuelve un arreglo json [[id_local, id_producto, ubicacion, cantidad], ...] en una sola
+-- respuesta: el GROUP BY corre una vez, sin páginas que lo repitan.
+
+drop function if exists stock_por_sede(boolean);
+
+create or replace function stock_por_sede(p_por_ubicacion boolean default false)
+returns jsonb
+language sql
+stable
+as $$
+    select coalesce(jsonb_agg(jsonb_build_array(t.id_local, t.id_producto, t.ubicacion, t.cantidad)), '[]'::jsonb)
+    from (
+        select m.id_local, m.id_producto,
+               case when p_por_ubicacion then m.ubicacion end as ubicacion,
+               sum(m.cantidad) as cantidad
+        from movimientos_inventario m
+        group by 1, 2, 3
+    ) t;
+$$;